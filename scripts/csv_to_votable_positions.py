@@ -14,12 +14,12 @@ if len(sys.argv) != 3:
 in_csv, out_vot = sys.argv[1], sys.argv[2]
 t = Table.read(in_csv, format="csv")
 
-# Encode row_id as ASCII bytes (digits only -> ASCII-safe):
-row_id_bytes = np.array([str(x).encode('ascii') for x in t['row_id']], dtype='S24')
+# Encode row_id as ASCII bytes (digits only -> ASCII-safe); numpy casts in C, no per-row loop:
+row_id_bytes = np.asarray(t['row_id']).astype('S24')
 out = Table()
 out['row_id'] = Column(row_id_bytes)                # -> VOTable FIELD datatype="char"
-out['ra']     = Column([float(x) for x in t['ra']],  dtype='float64')
-out['dec']    = Column([float(x) for x in t['dec']], dtype='float64')
+out['ra']     = Column(np.asarray(t['ra'],  dtype='float64'))
+out['dec']    = Column(np.asarray(t['dec'], dtype='float64'))
 
 out.write(out_vot, format="votable", overwrite=True)
 print(f"Wrote VOTable as ASCII char: {out_vot}  rows={len(out)}")
@@ -3,18 +3,28 @@ from __future__ import annotations
 
 import os
 import csv
+import atexit
 import json
+import queue
 import time
 import signal
 import logging
+import multiprocessing
 import sys
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pac
 
 TILE_PREFIX = "tile-RA"
 PS1_DEC_LIMIT = -30.0
 
+PS1_COLUMNS = {'raMean': 'ra', 'decMean': 'dec', 'rMeanPSFMag': 'rmag'}
+PS1_NULLS = ['', 'NaN', 'nan', 'NULL', 'null']
+
 
 def _add_repo_to_syspath() -> Path:
     """Make the repo importable if we later want to reuse helpers; safe no-op if already set."""
@@ -32,11 +42,25 @@ def _add_repo_to_syspath() -> Path:
     return Path.cwd().resolve()
 
 
+def _scan_tile_dirs(root: str):
+    try:
+        it = os.scandir(root)
+    except OSError:
+        return
+    with it:
+        for e in it:
+            if e.name.startswith(TILE_PREFIX) and "-DEC" in e.name:
+                if e.is_dir():
+                    yield e.path  # tiles are leaves: never descend into them
+            elif e.is_dir(follow_symlinks=False):
+                # like os.walk: symlinked tile dirs are listed, symlinked shards not followed
+                yield from _scan_tile_dirs(e.path)
+
+
 def iter_tile_dirs_sharded(tiles_root: Path):
-    for root, dirs, _files in os.walk(tiles_root):
-        for d in dirs:
-            if d.startswith(TILE_PREFIX) and "-DEC" in d:
-                yield Path(root) / d
+    """Tile dirs under the sharded tree; scandir's cached d_type avoids stat-ing every file."""
+    for p in _scan_tile_dirs(str(tiles_root)):
+        yield Path(p)
 
 
 def parse_center_from_tile_name(name: str):
@@ -57,11 +81,22 @@ def atomic_write_text(path: Path, text: str):
     tmp.replace(path)
 
 
+SPIKE_HEADER = b"ra,dec,rmag\n"
+# Longest header-only file any writer produced: quoted names + CRLF (csv module / early Arrow)
+_SPIKE_HEADER_MAX = len(b'"ra","dec","rmag"\r\n')
+
+
 def cache_has_data_rows(path: Path) -> bool:
-    """Return True if CSV exists and has at least one data row."""
+    """Return True if CSV exists and has at least one data row (stat-only unless size is ambiguous)."""
+    try:
+        size = path.stat().st_size
+    except OSError:
+        return False
+    if size <= len(SPIKE_HEADER):
+        return False
+    if size > _SPIKE_HEADER_MAX:
+        return True
     try:
-        if not path.exists() or path.stat().st_size == 0:
-            return False
         with path.open('r', encoding='utf-8', errors='ignore', newline='') as f:
             r = csv.reader(f)
             next(r, None)  # header
@@ -75,28 +110,141 @@ def _outside_ps1_coverage(dec_deg: float, radius_arcmin: float) -> bool:
     return (float(dec_deg) + radius_deg) < PS1_DEC_LIMIT
 
 
-def write_spike_cache(out_path: Path, rows: list[dict]):
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    tmp = out_path.with_suffix(out_path.suffix + ".tmp")
-    with tmp.open('w', newline='', encoding='utf-8') as f:
-        w = csv.DictWriter(f, fieldnames=['ra', 'dec', 'rmag'])
-        w.writeheader()
-        for row in rows:
-            w.writerow(row)
-    tmp.replace(out_path)
+def read_csv_header(path: Path) -> list[str]:
+    with path.open('r', encoding='utf-8', errors='ignore', newline='') as f:
+        return next(csv.reader(f), [])
 
 
-def write_empty_spike_cache(out_path: Path):
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    tmp = out_path.with_suffix(out_path.suffix + ".tmp")
-    with tmp.open('w', newline='', encoding='utf-8') as f:
-        w = csv.DictWriter(f, fieldnames=['ra', 'dec', 'rmag'])
-        w.writeheader()
-    tmp.replace(out_path)
+SPIKE_SCHEMA = pa.schema([('ra', pa.float64()), ('dec', pa.float64()), ('rmag', pa.float64())])
 
 
-class StopRequested(Exception):
-    pass
+def _bright_rows(batch: pa.RecordBatch, rmag_max: float, mindet: int, use_ndet: bool) -> pa.RecordBatch:
+    """
+    Keep rows with finite ra/dec/rmag, rmag <= rmag_max and (if present)
+    nDetections >= mindet (missing count -> 0). Returns an (ra, dec, rmag) batch.
+    """
+    ra, dec, rmag = batch.column('raMean'), batch.column('decMean'), batch.column('rMeanPSFMag')
+    mask = pc.less_equal(rmag, float(rmag_max))
+    for col in (ra, dec):
+        mask = pc.and_(mask, pc.invert(pc.is_nan(col)))
+    if use_ndet:
+        ndet = pc.trunc(pc.fill_null(batch.column('nDetections'), 0.0))
+        mask = pc.and_(mask, pc.greater_equal(ndet, int(mindet)))
+    # null anywhere -> null mask -> dropped by filter
+    return pa.RecordBatch.from_arrays([pc.filter(c, mask) for c in (ra, dec, rmag)], schema=SPIKE_SCHEMA)
+
+
+def write_spike_cache(out_path: Path, batches) -> int:
+    """
+    Write (ra, dec, rmag) batches to the spike cache via tmp + fsync + rename; returns rows.
+    The header is always written, so no batches gives the empty (header-only) cache.
+    """
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = out_path.with_suffix(out_path.suffix + ".tmp")
+    n = 0
+    try:
+        # numeric columns only, so an unquoted header/body is plain ra,dec,rmag CSV
+        opts = pac.WriteOptions(quoting_style='none', quoting_header='none')
+        with pac.CSVWriter(str(tmp), SPIKE_SCHEMA, write_options=opts) as w:
+            for batch in batches:
+                if batch.num_rows:
+                    w.write_batch(batch)
+                    n += batch.num_rows
+        fd = os.open(tmp, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    os.replace(tmp, out_path)
+    return n
+
+
+def derive_spike_cache(ps1_neigh: Path, out_path: Path, rmag_max: float, mindet: int, use_ndet: bool) -> int:
+    """
+    Stream ps1_neighbourhood.csv through Arrow (one ~8 MiB batch resident at a time),
+    filter each batch and append it to the spike cache; returns stars written.
+    """
+    cols = list(PS1_COLUMNS) + (['nDetections'] if use_ndet else [])
+    # parse straight from mmap'd pages (no read() copy into Python-side buffers)
+    with pa.memory_map(str(ps1_neigh), 'r') as src:
+        reader = pac.open_csv(
+            src,
+            read_options=pac.ReadOptions(block_size=8 << 20),
+            convert_options=pac.ConvertOptions(
+                include_columns=cols,
+                column_types={c: pa.float64() for c in cols},
+                null_values=PS1_NULLS,
+            ),
+        )
+        return write_spike_cache(out_path, (_bright_rows(b, rmag_max, mindet, use_ndet) for b in reader))
+
+
+_STOP = None  # multiprocessing.Event shared with the parent (set in each worker)
+
+
+def _init_worker(stop_event):
+    # Parent owns SIGINT/SIGTERM and drains in-flight tiles; one Arrow thread per process.
+    global _STOP
+    _STOP = stop_event
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    pa.set_cpu_count(1)
+
+
+def do_one_worker(tile_dir_str: str, rmag_max: float, mindet: int, radius_arcmin: float,
+                  overwrite: bool):
+    """Process one tile in a worker process; only primitives cross the process boundary."""
+    tile_dir = Path(tile_dir_str)
+    tile_id = tile_dir.name
+
+    ps1_neigh = tile_dir / 'catalogs' / 'ps1_neighbourhood.csv'
+    out = tile_dir / 'catalogs' / 'ps1_bright_stars_r16_rad35.csv'
+
+    if (not overwrite) and cache_has_data_rows(out):
+        return ('cached', tile_id, 0)
+
+    ctr = parse_center_from_tile_name(tile_id)
+    if not ctr:
+        return ('no_center', tile_id, 0)
+    ra0, dec0 = ctr
+
+    # If entire cone is below PS1 footprint, write empty and mark outside
+    if _outside_ps1_coverage(dec0, radius_arcmin):
+        write_spike_cache(out, ())
+        return ('outside', tile_id, 0)
+
+    if not ps1_neigh.exists() or ps1_neigh.stat().st_size == 0:
+        return ('missing_neigh', tile_id, 0)
+
+    # Read PS1 neighbourhood and filter (Arrow parse + compute kernels)
+    try:
+        fieldnames = read_csv_header(ps1_neigh)
+        need = set(PS1_COLUMNS)
+        if not need.issubset(set(fieldnames)):
+            # can't derive reliably
+            return ('failed', tile_id, f'missing columns: {sorted(list(need - set(fieldnames)))}')
+
+        n = derive_spike_cache(ps1_neigh, out, rmag_max, mindet,
+                               use_ndet='nDetections' in fieldnames)
+        return ('written', tile_id, n)
+    except Exception as e:
+        return ('failed', tile_id, str(e))
+
+
+def do_chunk_worker(tile_dir_strs: list[str], rmag_max: float, mindet: int, radius_arcmin: float,
+                    overwrite: bool) -> list:
+    """Process a run of adjacent tiles in one task; stops early (keeping finished results) on stop."""
+    results = []
+    for td in tile_dir_strs:
+        if _STOP is not None and _STOP.is_set():
+            break
+        try:
+            results.append(do_one_worker(td, rmag_max, mindet, radius_arcmin, overwrite))
+        except Exception as e:
+            results.append(('failed', Path(td).name, f'unexpected={e}'))
+    return results
 
 
 def main():
@@ -118,6 +266,8 @@ def main():
                     help='Overwrite spike cache even if it already has data rows')
     ap.add_argument('--limit', type=int, default=0)
     ap.add_argument('--progress-every', type=int, default=200)
+    ap.add_argument('--chunk-size', type=int, default=64,
+                    help='Tiles per worker task (capped so every worker gets work)')
     args = ap.parse_args()
 
     tiles_root = Path(args.tiles_root)
@@ -128,19 +278,24 @@ def main():
     progress_path = logs_dir / 'derive_spike_cache_from_ps1_neighbourhood_progress.json'
     stop_file = logs_dir / 'DERIVE_SPIKE_STOP'
 
+    # The file/stream writes happen on a listener thread; the result loop only enqueues.
+    # (QueueHandler.prepare still merges the %-args into the message in the logging thread.)
     logger = logging.getLogger('derive_spike')
     logger.setLevel(logging.INFO)
     handler = RotatingFileHandler(log_path, maxBytes=10_000_000, backupCount=5, encoding='utf-8')
     handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-    logger.addHandler(handler)
     sh = logging.StreamHandler()
     sh.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(message)s'))
-    logger.addHandler(sh)
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(QueueHandler(log_queue))
+    listener = QueueListener(log_queue, handler, sh)
+    listener.start()
+    atexit.register(listener.stop)  # drains queued records on exit
 
-    stop = {'flag': False}
+    stop_event = multiprocessing.Event()
 
     def _sig_handler(_sig, _frame):
-        stop['flag'] = True
+        stop_event.set()
         logger.warning('Stop signal received; exiting after in-flight tasks complete.')
 
     signal.signal(signal.SIGINT, _sig_handler)
@@ -166,69 +321,9 @@ def main():
     def write_progress():
         atomic_write_text(progress_path, json.dumps(counters, indent=2))
 
-    def do_one(tile_dir: Path):
-        if stop['flag'] or stop_file.exists():
-            raise StopRequested()
-
-        tile_id = tile_dir.name
-        counters['last_tile'] = tile_id
-
-        ps1_neigh = tile_dir / 'catalogs' / 'ps1_neighbourhood.csv'
-        out = tile_dir / 'catalogs' / 'ps1_bright_stars_r16_rad35.csv'
-
-        if (not args.overwrite) and cache_has_data_rows(out):
-            return ('cached', tile_id, 0)
-
-        ctr = parse_center_from_tile_name(tile_id)
-        if not ctr:
-            return ('no_center', tile_id, 0)
-        ra0, dec0 = ctr
-
-        # If entire cone is below PS1 footprint, write empty and mark outside
-        if _outside_ps1_coverage(dec0, args.radius_arcmin):
-            write_empty_spike_cache(out)
-            return ('outside', tile_id, 0)
-
-        if not ps1_neigh.exists() or ps1_neigh.stat().st_size == 0:
-            return ('missing_neigh', tile_id, 0)
-
-        # Read PS1 neighbourhood and filter
-        try:
-            with ps1_neigh.open('r', encoding='utf-8', errors='ignore', newline='') as f:
-                rdr = csv.DictReader(f)
-                fieldnames = rdr.fieldnames or []
-                need = {'raMean', 'decMean', 'rMeanPSFMag'}
-                if not need.issubset(set(fieldnames)):
-                    # can't derive reliably
-                    return ('failed', tile_id, f'missing columns: {sorted(list(need - set(fieldnames)))}')
-
-                use_ndet = 'nDetections' in fieldnames
-                out_rows = []
-                for row in rdr:
-                    try:
-                        rmag = float(row.get('rMeanPSFMag', 'nan'))
-                        if rmag > float(args.rmag_max):
-                            continue
-                        if use_ndet:
-                            nd = int(float(row.get('nDetections', '0') or 0))
-                            if nd < int(args.mindetections):
-                                continue
-                        ra = float(row.get('raMean', 'nan'))
-                        dec = float(row.get('decMean', 'nan'))
-                        if not (ra == ra and dec == dec and rmag == rmag):
-                            continue
-                        out_rows.append({'ra': ra, 'dec': dec, 'rmag': rmag})
-                    except Exception:
-                        continue
-
-            write_spike_cache(out, out_rows)
-            return ('written', tile_id, len(out_rows))
-        except Exception as e:
-            return ('failed', tile_id, str(e))
-
     tiles = list(iter_tile_dirs_sharded(tiles_root))
     counters['tiles_found'] = len(tiles)
-    logger.info(f"derive start: tiles_root={tiles_root} tiles_found={len(tiles)} workers={args.workers}")
+    logger.info("derive start: tiles_root=%s tiles_found=%d workers=%d", tiles_root, len(tiles), args.workers)
     write_progress()
 
     to_run = []
@@ -236,22 +331,41 @@ def main():
         if args.limit and len(to_run) >= args.limit:
             break
         to_run.append(td)
+    # Keep each shard's tiles adjacent and hand them out in contiguous runs, so a worker
+    # stays within one directory subtree (page cache / disk locality) and IPC is per run.
+    to_run.sort(key=lambda td: (str(td.parent), td.name))
+    workers = max(1, args.workers)
+    chunk = max(1, min(int(args.chunk_size), len(to_run) // (workers * 4)))
+    chunks = [to_run[i:i + chunk] for i in range(0, len(to_run), chunk)]
     counters['tiles_scheduled'] = len(to_run)
-    logger.info(f"derive scheduled: {len(to_run)} tiles")
+    logger.info("derive scheduled: %d tiles", len(to_run))
     write_progress()
 
     done = 0
-    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as ex:
-        futs = {ex.submit(do_one, td): td for td in to_run}
+    if stop_file.exists():
+        stop_event.set()
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(stop_event,)) as ex:
+        futs = {
+            ex.submit(do_chunk_worker, [str(td) for td in tds], float(args.rmag_max),
+                      int(args.mindetections), float(args.radius_arcmin), bool(args.overwrite)): tds
+            for tds in chunks
+        }
+        cancelled = False
         for fut in as_completed(futs):
-            td = futs[fut]
+            if fut.cancelled():
+                continue
             try:
-                status, tile_id, meta = fut.result()
+                results = fut.result()
+            except Exception as e:
+                results = [('failed', td.name, f'unexpected={e}') for td in futs[fut]]
+            for status, tile_id, meta in results:
+                counters['last_tile'] = tile_id
                 if status == 'cached':
                     counters['tiles_cached_skip'] += 1
                 elif status == 'outside':
                     counters['tiles_ps1_outside_coverage'] += 1
-                    logger.info(f"[SKIP] {tile_id} ps1_outside_coverage (wrote empty spike cache)")
+                    logger.info("[SKIP] %s ps1_outside_coverage (wrote empty spike cache)", tile_id)
                 elif status == 'missing_neigh':
                     counters['tiles_missing_ps1_neighbourhood'] += 1
                 elif status == 'written':
@@ -260,32 +374,36 @@ def main():
                     counters['total_stars_written'] += n
                     if n == 0:
                         counters['tiles_zero_stars'] += 1
-                    logger.info(f"[OK] {tile_id} spike_cache stars={n}")
+                    logger.info("[OK] %s spike_cache stars=%d", tile_id, n)
                 elif status == 'no_center':
                     counters['tiles_no_center'] += 1
-                    logger.warning(f"[SKIP] {tile_id} no_center")
+                    logger.warning("[SKIP] %s no_center", tile_id)
                 else:
                     counters['tiles_failed'] += 1
-                    logger.warning(f"[FAIL] {tile_id} err={meta}")
-            except StopRequested:
-                logger.warning('StopRequested: exiting loop.')
-                stop['flag'] = True
-                break
-            except Exception as e:
-                counters['tiles_failed'] += 1
-                logger.warning(f"[FAIL] {td.name} unexpected={e}")
-
-            done += 1
-            if done % int(args.progress_every) == 0:
-                write_progress()
-                logger.info(
-                    f"progress: done={done}/{len(to_run)} "
-                    f"written={counters['tiles_written']} cached={counters['tiles_cached_skip']} "
-                    f"missing_neigh={counters['tiles_missing_ps1_neighbourhood']} outside={counters['tiles_ps1_outside_coverage']}"
-                )
+                    logger.warning("[FAIL] %s err=%s", tile_id, meta)
+
+                done += 1
+                if done % int(args.progress_every) == 0:
+                    # stop file is an escape hatch for detached runs; polled only at progress ticks
+                    if stop_file.exists():
+                        stop_event.set()
+                    write_progress()
+                    logger.info(
+                        "progress: done=%d/%d written=%d cached=%d missing_neigh=%d outside=%d",
+                        done, len(to_run), counters['tiles_written'], counters['tiles_cached_skip'],
+                        counters['tiles_missing_ps1_neighbourhood'], counters['tiles_ps1_outside_coverage'],
+                    )
+
+            # Workers see the event and stop mid-run; cancel queued runs, keep draining the
+            # running ones so tiles they already wrote are still counted.
+            if stop_event.is_set() and not cancelled:
+                logger.warning('Stop requested: cancelling queued tiles.')
+                for f in futs:
+                    f.cancel()
+                cancelled = True
 
     write_progress()
-    logger.info('derive done: ' + json.dumps(counters))
+    logger.info('derive done: %s', json.dumps(counters))
 
 
 if __name__ == '__main__':
@@ -11,8 +11,9 @@ Why this script?
     them all at once can OOM. This tool processes one partition file at a time,
     writing a mirrored partitioned output tree.
   - Flag tables (VOSA-like, SCOS, PTF ngood, VSX, SkyBoT) are reduced to
-    compact in-memory key indices so per-partition lookups are O(1) and memory
-    stays bounded (≈ a few million keys at most).
+    compact in-memory key indices (sorted int64 NUMBER arrays, per tile_id) so
+    per-partition lookups are vectorized binary searches and memory stays
+    bounded (≈ a few million keys at most).
 
 Inputs
   --survivors-root DIR
@@ -44,8 +45,12 @@ Output
 import argparse
 import json
 from pathlib import Path
-from typing import Dict, Set, Tuple, Optional
+from typing import Dict, Tuple, Optional
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as pds
+import pyarrow.parquet as pq
 
 # ------------------------ utilities ---------------------------------------
 
@@ -64,44 +69,66 @@ def list_partitions(root: Path, ra_subset=None, dec_subset=None):
 
 
 def read_parquet_any(path: Path, columns=None) -> pd.DataFrame:
-    if path.is_dir():
-        try:
-            return pd.read_parquet(path, columns=columns, engine='pyarrow')
-        except Exception:
-            parts = sorted(path.glob('**/*.parquet'))
-            dfs = [pd.read_parquet(p, columns=columns) for p in parts]
-            return pd.concat(dfs, ignore_index=True)
-    else:
-        return pd.read_parquet(path, columns=columns)
+    """
+    One threaded Arrow scan (file or hive directory) handed to pandas in a single
+    conversion; columns not present in the schema are skipped rather than failing.
+    """
+    try:
+        dset = pds.dataset(str(path), format='parquet',
+                           partitioning='hive' if path.is_dir() else None)
+        cols = None if columns is None else [c for c in columns if c in dset.schema.names]
+        tbl = dset.to_table(columns=cols, use_threads=True)
+    except Exception:
+        if not path.is_dir():
+            raise
+        # parts whose schemas do not unify: read one by one and promote
+        parts = sorted(path.glob('**/*.parquet'))
+        tbls = []
+        for p in parts:
+            names = pq.read_schema(p).names
+            tbls.append(pq.read_table(p, columns=None if columns is None else [c for c in columns if c in names]))
+        tbl = pa.concat_tables(tbls, promote_options='permissive')
+    return tbl.to_pandas(self_destruct=True, split_blocks=True)
 
 # ------------------------ flag index builders -----------------------------
 
-def _keys_from_df(df: pd.DataFrame) -> Tuple[Dict[str, Set[int]], Set[int]]:
-    """Return (tile_to_numbers, numbers_only) where tile_to_numbers maps tile_id->set(NUMBER)
+FlagIndex = Tuple[Dict[str, np.ndarray], np.ndarray]
+_NO_KEYS = np.empty(0, dtype=np.int64)
+
+
+def _keys_from_df(df: pd.DataFrame) -> FlagIndex:
+    """Return (tile_to_numbers, numbers_only) where tile_to_numbers maps tile_id->sorted NUMBER array
     and numbers_only is used when tile_id is absent in survivors.
-    NUMBER is assumed integer-like where possible; we store as Python int to lower memory.
+    NUMBER is assumed integer-like; sorted unique int64 arrays are far smaller than sets of Python ints.
     """
-    tile_map: Dict[str, Set[int]] = {}
-    num_set: Set[int] = set()
+    tile_map: Dict[str, np.ndarray] = {}
+    num_set = _NO_KEYS
     has_tile = 'tile_id' in df.columns
     has_num  = 'NUMBER' in df.columns
     if not has_num:
         return tile_map, num_set
     if has_tile:
         for tile, sub in df[['tile_id','NUMBER']].dropna().astype({'NUMBER':'int64'}).groupby('tile_id'):
-            tile_map.setdefault(str(tile), set()).update(sub['NUMBER'].tolist())
+            keys = sub['NUMBER'].to_numpy()
+            prev = tile_map.get(str(tile))
+            tile_map[str(tile)] = np.unique(keys if prev is None else np.concatenate([prev, keys]))
     else:
-        num_set.update(df['NUMBER'].dropna().astype('int64').tolist())
+        num_set = np.unique(df['NUMBER'].dropna().astype('int64').to_numpy())
     return tile_map, num_set
 
 
-def build_flag_index(path: Optional[str], label: str, columns_hint=None) -> Tuple[Dict[str, Set[int]], Set[int]]:
+def has_keys(idx: FlagIndex) -> bool:
+    tmap, nset = idx
+    return bool(tmap) or len(nset) > 0
+
+
+def build_flag_index(path: Optional[str], label: str, columns_hint=None) -> FlagIndex:
     if not path:
-        return {}, set()
+        return {}, _NO_KEYS
     p = Path(path)
     if not p.exists():
         print(f"[WARN] {label}: path not found {p} — skipping")
-        return {}, set()
+        return {}, _NO_KEYS
     cols = ['tile_id','NUMBER']
     if columns_hint:
         cols = sorted(set(cols + columns_hint))
@@ -116,14 +143,39 @@ def build_flag_index(path: Optional[str], label: str, columns_hint=None) -> Tupl
 
 # ----------------------------- per-chunk filter ---------------------------
 
-def in_flag(tile: Optional[str], num: Optional[int], tmap: Dict[str, Set[int]], nset: Set[int]) -> bool:
-    if num is None:
-        return False
-    if tmap and tile is not None and tile in tmap:
-        return num in tmap[tile]
-    if nset:
-        return num in nset
-    return False
+def _member(sorted_keys: np.ndarray, values: np.ndarray) -> np.ndarray:
+    """values ∈ sorted_keys, elementwise (binary search; no hash set rebuilt per call)."""
+    if len(sorted_keys) == 0:
+        return np.zeros(len(values), dtype=bool)
+    pos = np.searchsorted(sorted_keys, values)
+    pos[pos == len(sorted_keys)] = 0
+    return sorted_keys[pos] == values
+
+
+def flag_hits(df: pd.DataFrame, idx: FlagIndex) -> np.ndarray:
+    """
+    Vectorized membership of (tile_id, NUMBER) rows in a flag index. Rows whose
+    tile has an entry in the tile map are tested against that tile's NUMBERs;
+    the rest fall back to the NUMBER-only keys. Null NUMBER never hits.
+    """
+    tmap, nset = idx
+    hits = np.zeros(len(df), dtype=bool)
+    if 'NUMBER' not in df.columns or len(df) == 0:
+        return hits
+    valid = df['NUMBER'].notna().to_numpy()
+    nums = df['NUMBER'].to_numpy(dtype=np.int64, na_value=0)
+    rest = np.ones(len(df), dtype=bool)
+    if tmap and 'tile_id' in df.columns:
+        tiles = df['tile_id'].astype(str).to_numpy()
+        for tile, rows in pd.Series(tiles).groupby(tiles, sort=False).indices.items():
+            keys = tmap.get(tile)
+            if keys is None:
+                continue
+            rest[rows] = False
+            hits[rows] = _member(keys, nums[rows])
+    if len(nset) and rest.any():
+        hits[rest] = _member(nset, nums[rest])
+    return hits & valid
 
 
 def process_partition(src_file: Path,
@@ -132,8 +184,10 @@ def process_partition(src_file: Path,
                       max_rows_left: Optional[int]=None,
                       dry_run=False) -> Tuple[int,int,dict]:
     # read minimal columns; allow extra commonly used identifiers
+    # (projection is chosen from the footer schema, so only these columns are decoded)
     cols = ['tile_id','NUMBER','plate_id','RA','Dec','RA_corr','Dec_corr','ALPHAWIN_J2000','DELTAWIN_J2000']
-    df = pd.read_parquet(src_file, columns=[c for c in cols if c in pd.read_parquet(src_file, columns=[]).columns])
+    names = set(pq.read_schema(src_file).names)
+    df = pq.read_table(src_file, columns=[c for c in cols if c in names]).to_pandas(self_destruct=True)
 
     # Early exit for test limit
     if max_rows_left is not None and len(df) > max_rows_left:
@@ -143,21 +197,11 @@ def process_partition(src_file: Path,
     if 'NUMBER' in df.columns:
         df['NUMBER'] = pd.to_numeric(df['NUMBER'], errors='coerce').astype('Int64')
 
-    # compute drops
-    def hit(label, idx_pair):
-        tmap, nset = idx_pair
-        return df.apply(lambda r: in_flag(str(r['tile_id']) if 'tile_id' in df.columns else None,
-                                          int(r['NUMBER']) if pd.notna(r['NUMBER']) else None,
-                                          tmap, nset), axis=1)
-
-    h_vosa = hit('vosa_like', vosa_idx) if any(vosa_idx) else pd.Series(False, index=df.index)
-    h_scos = hit('scos',      scos_idx) if any(scos_idx) else pd.Series(False, index=df.index)
-    h_ptf  = hit('ptf_ngood', ptf_idx)  if any(ptf_idx)  else pd.Series(False, index=df.index)
-    h_vsx  = hit('vsx',       vsx_idx)  if any(vsx_idx)  else pd.Series(False, index=df.index)
-    h_sky  = hit('skybot',    sky_idx)  if any(sky_idx)  else pd.Series(False, index=df.index)
-
-    drop_any = (h_vosa | h_scos | h_ptf | h_vsx | h_sky)
-    kept = df.loc[~drop_any].copy()
+    # compute drops: one bool array per loaded flag table, OR-reduced in a single pass
+    flags = {'vosa_like': vosa_idx, 'scos': scos_idx, 'ptf_ngood': ptf_idx, 'vsx': vsx_idx, 'skybot': sky_idx}
+    hits = {name: flag_hits(df, idx) for name, idx in flags.items() if has_keys(idx)}
+    drop_any = np.logical_or.reduce(list(hits.values())) if hits else np.zeros(len(df), dtype=bool)
+    kept = df.loc[~drop_any]
 
     # write
     written = 0
@@ -173,11 +217,7 @@ def process_partition(src_file: Path,
     stats = {
         'src_rows': int(len(df)),
         'kept_rows': int(len(kept)),
-        'drop_vosa_like': int(h_vosa.sum()),
-        'drop_scos': int(h_scos.sum()),
-        'drop_ptf_ngood': int(h_ptf.sum()),
-        'drop_vsx': int(h_vsx.sum()),
-        'drop_skybot': int(h_sky.sum()),
+        **{f'drop_{name}': int(hits[name].sum()) if name in hits else 0 for name in flags},
     }
     return len(df), written, stats
 
@@ -205,7 +245,7 @@ def main():
     ra_subset = set(x.strip() for x in args.ra_bin.split(',') if x.strip()) or None
     dec_subset = set(x.strip() for x in args.dec_bin.split(',') if x.strip()) or None
 
-    # Build compact indices for flag datasets (tile_id -> set(NUMBER))
+    # Build compact indices for flag datasets (tile_id -> sorted NUMBER array)
     print('[INFO] Building flag indices...')
     vosa_idx = build_flag_index(args.vosa_like, 'VOSA-like')
     scos_idx = build_flag_index(args.scos, 'SCOS')
@@ -3,15 +3,26 @@
 # Keep the closest NEOWISE-SE row per row_id and add sep_arcsec (if needed).
 # Input CSV must include at least: row_id, ra, dec; optionally in_ra, in_dec, sep_deg
 import sys, math
+import numpy as np
 import pandas as pd
 
 def sep_arcsec(ra1, dec1, ra2, dec2):
+    # Haversine, vectorised over numpy arrays (NaN in -> NaN out). Unlike acos it
+    # does not cancel at sub-arcsec separations. Kept in float64: float32 RA near
+    # 360 deg only resolves ~0.1", too coarse for ranking inside a 5" radius.
     d2r = math.pi/180.0
-    ra1, dec1, ra2, dec2 = ra1*d2r, dec1*d2r, ra2*d2r, dec2*d2r
-    s = math.acos(max(-1.0, min(1.0,
-        math.sin(dec1)*math.sin(dec2) + math.cos(dec1)*math.cos(dec2)*math.cos(ra1-ra2)
-    )))
-    return s*(180.0/math.pi)*3600.0
+    dec1, dec2 = dec1*d2r, dec2*d2r
+    a = np.sin((ra1 - ra2)*(d2r/2))
+    a *= a
+    a *= np.cos(dec1)
+    a *= np.cos(dec2)
+    h = np.sin((dec1 - dec2)/2)
+    a += h*h
+    np.clip(a, 0.0, 1.0, out=a)
+    np.sqrt(a, out=a)
+    np.arcsin(a, out=a)
+    a *= 2*(180.0/math.pi)*3600.0
+    return a
 
 if len(sys.argv) != 3:
     print("Usage: closest_per_row_id.py <in_raw.csv> <out_closest.csv>")
@@ -26,17 +37,17 @@ if 'sep_deg' in df.columns:
 else:
     # Need in_ra/in_dec to compute; if absent, assume matches are valid and set huge sep
     if {'in_ra','in_dec'}.issubset(df.columns):
-        df['sep_arcsec'] = [
-            sep_arcsec(ra1, dec1, ra2, dec2)
-            for ra1,dec1,ra2,dec2 in zip(df['in_ra'], df['in_dec'], df['ra'], df['dec'])
-        ]
+        ra1, dec1, ra2, dec2 = (pd.to_numeric(df[c], errors='coerce').to_numpy(np.float64)
+                                for c in ('in_ra', 'in_dec', 'ra', 'dec'))
+        df['sep_arcsec'] = sep_arcsec(ra1, dec1, ra2, dec2)
     else:
         df['sep_arcsec'] = 1e9  # fallback; still allows grouping but will not rank by proximity
 
-# Sort & keep first per row_id
-sort_cols = ['row_id','sep_arcsec']
-df.sort_values(sort_cols, ascending=[True, True], inplace=True)
-closest = df.groupby('row_id', as_index=False).first()
+# Keep the min-separation row per row_id: one hash groupby pass, no full sort.
+# NaN separations rank last (as they did when sorting); output stays ordered by row_id.
+key = df['sep_arcsec'].fillna(float('inf'))
+best = key.groupby(df['row_id'], sort=True).idxmin()
+closest = df.loc[best.to_numpy()].reset_index(drop=True)
 
 closest.to_csv(out_csv, index=False)
 print(f"Wrote closest-per-row: {out_csv} (rows={len(closest)})")
@@ -47,11 +47,11 @@ def to_unit_sphere_xyz(ra_deg, dec_deg):
     return np.column_stack((x, y, z))
 
 def angsep_arcsec(ra1_deg, dec1_deg, ra2_deg, dec2_deg):
+    # haversine: stable for the sub-arcsec separations we report (acos cancels there)
     ra1 = np.deg2rad(ra1_deg); dec1 = np.deg2rad(dec1_deg)
     ra2 = np.deg2rad(ra2_deg); dec2 = np.deg2rad(dec2_deg)
-    cos_d = np.sin(dec1)*np.sin(dec2) + np.cos(dec1)*np.cos(dec2)*np.cos(ra1-ra2)
-    cos_d = np.clip(cos_d, -1.0, 1.0)
-    return np.rad2deg(np.arccos(cos_d)) * 3600.0
+    a = np.sin((dec2-dec1)/2)**2 + np.cos(dec1)*np.cos(dec2)*np.sin((ra2-ra1)/2)**2
+    return np.rad2deg(2*np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))) * 3600.0
 
 def read_vasco_csv(path):
     df = pd.read_csv(path)
@@ -20,19 +20,52 @@ Usage:
   python scripts/concat_flags_and_write_sidecar.py \
     --closest-dir ./data/local-cats/tmp/positions \
     --out-root ./data/local-cats/_master_optical_parquet_irflags \
-    --radius-arcsec 5.0
+    --radius-arcsec 5.0 \
+    --workers 8
 """
 
 import argparse
+import csv
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import nullcontext
+from itertools import repeat
 from pathlib import Path
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
 
+# ---- Make scripts/ importable without requiring it to be a Python package ----
+SCRIPTS_DIR = Path(__file__).resolve().parents[1]
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+from utils_fs import atomic_write_text, fsync_path, scan_closest
+
+# Types pinned at parse time: keys never pass through float, separations land
+# as float64 directly. Columns absent from a given file are simply ignored.
+CLOSEST_COLUMN_TYPES = {
+    "row_id": pa.string(),
+    "NUMBER": pa.string(),
+    "dist_arcsec": pa.float64(),
+    "sep_arcsec": pa.float64(),
+    "distance_arcsec": pa.float64(),
+    "separation_arcsec": pa.float64(),
+}
+
+# Columns normalize_df reads; anything else in a closest CSV is not parsed at all, so an
+# unrelated column whose type drifts after the first block cannot fail the file.
+CLOSEST_COLUMNS = tuple(CLOSEST_COLUMN_TYPES) + ("has_ir_match", "ir_match_strict")
+
+# Per-file results are small; buffer them so the sidecar gets a few large row
+# groups instead of one tiny row group per *_closest.csv.
+ROW_GROUP_ROWS = 256_000
+
 
 def parse_args():
     p = argparse.ArgumentParser()
@@ -40,20 +73,38 @@ def parse_args():
     p.add_argument("--out-root", required=True, help="Output root for Parquet sidecar")
     p.add_argument("--radius-arcsec", type=float, default=5.0, help="IR match radius threshold")
     p.add_argument("--out-name", default="neowise_se_flags_ALL.parquet", help="Output parquet filename")
+    p.add_argument("--workers", type=int, default=0,
+                   help="Processes for CSV parse/collapse (0=auto, 1=single-process)")
     return p.parse_args()
 
 
 def find_closest_csvs(root: Path) -> List[Path]:
-    files: List[Path] = []
-    for base in (root, root / "new"):
-        if not base.exists():
-            continue
-        for dirpath, _dirnames, filenames in os.walk(base):
-            for fn in filenames:
-                if fn.endswith("_closest.csv"):
-                    files.append(Path(dirpath) / fn)
-    files.sort()
-    return files
+    found: List[str] = []
+    scan_closest(str(root), found)
+    # root/new is covered by the walk above unless it is a symlink (not followed)
+    if (root / "new").is_symlink():
+        scan_closest(str(root / "new"), found)
+    return [Path(p) for p in sorted(set(found))]
+
+
+def read_closest_csv(path: Path) -> pd.DataFrame:
+    """
+    Read one *_closest.csv with the multithreaded Arrow CSV parser.
+    Only CLOSEST_COLUMNS present in the header are parsed. Empty cells become nulls
+    (same as pandas), string columns map to pandas "string".
+    """
+    with path.open(newline="") as f:
+        header = next(csv.reader(f), [])
+    tbl = pacsv.read_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=8 << 20),
+        convert_options=pacsv.ConvertOptions(
+            column_types=CLOSEST_COLUMN_TYPES,
+            include_columns=[c for c in header if c in CLOSEST_COLUMNS],
+            strings_can_be_null=True,
+        ),
+    )
+    return tbl.to_pandas(types_mapper={pa.string(): pd.StringDtype()}.get)
 
 
 def _normalize_row_id_series(s: pd.Series) -> pd.Series:
@@ -113,29 +164,39 @@ def normalize_df(df: pd.DataFrame, radius: float) -> pd.DataFrame:
     return df[keep].copy()
 
 
-def collapse_per_row_id(df_norm: pd.DataFrame) -> pd.DataFrame:
+def collapse_per_row_id(df_norm: pd.DataFrame) -> pa.Table:
     """
-    Collapse to exactly one row per row_id:
+    Collapse to exactly one row per row_id (single Arrow hash aggregation):
     - has_ir_match: any(True)
-    - dist_arcsec: min(dist_arcsec) among matches (NaN if none)
+    - dist_arcsec: min(dist_arcsec) among matches (null if none)
+    Rows with a null row_id are dropped, as pandas groupby did.
     """
-    # Ensure row_id string
-    df_norm["row_id"] = df_norm["row_id"].astype("string")
+    tbl = pa.Table.from_pandas(df_norm, preserve_index=False)
+    tbl = tbl.filter(pc.is_valid(tbl["row_id"]))
 
     # If dist_arcsec missing, just any(True)
-    if "dist_arcsec" not in df_norm.columns:
-        g = df_norm.groupby("row_id", as_index=False)["has_ir_match"].any()
-        g["dist_arcsec"] = pd.NA
-        return g[["row_id", "has_ir_match", "dist_arcsec"]]
-
-    g = (
-        df_norm.groupby("row_id", as_index=False)
-        .agg(
-            has_ir_match=("has_ir_match", "any"),
-            dist_arcsec=("dist_arcsec", "min"),
-        )
+    if "dist_arcsec" not in tbl.column_names:
+        tbl = tbl.append_column("dist_arcsec", pa.nulls(tbl.num_rows, type=pa.float64()))
+
+    g = tbl.group_by("row_id").aggregate([("has_ir_match", "any"), ("dist_arcsec", "min")])
+    out = pa.table(
+        {
+            "row_id": g["row_id"],
+            "has_ir_match": g["has_ir_match_any"],
+            "dist_arcsec": g["dist_arcsec_min"],
+        }
     )
-    return g[["row_id", "has_ir_match", "dist_arcsec"]]
+    return out.sort_by("row_id")
+
+
+def load_one(path: Path, radius: float) -> Tuple[Path, int, Optional[pa.Table], Optional[str]]:
+    """Parse, normalize and collapse one closest CSV; errors are returned, not raised."""
+    try:
+        # Key columns are parsed as text; NUMBER is renamed in normalize_df.
+        df_norm = normalize_df(read_closest_csv(path), radius)
+        return path, df_norm.shape[0], collapse_per_row_id(df_norm), None
+    except Exception as e:
+        return path, 0, None, str(e)
 
 
 def main():
@@ -158,36 +219,56 @@ def main():
         ]
     )
 
-    writer = pq.ParquetWriter(out_path, schema)
+    # row_id is (near) unique, so dictionary pages would only be discarded.
+    writer = pq.ParquetWriter(
+        out_path,
+        schema,
+        compression="zstd",
+        compression_level=3,
+        use_dictionary=False,
+        data_page_size=1 << 20,
+    )
+    pending: List[pa.Table] = []
+    pending_rows = 0
     rows_in = 0
     groups_written = 0
 
-    for i, f in enumerate(inputs, 1):
-        try:
-            # Force key column to remain text if present.
-            # If file uses NUMBER, pandas will still read it; we normalize later.
-            df = pd.read_csv(
-                f,
-                dtype={"row_id": "string", "NUMBER": "string"},
-                low_memory=False,
-            )
-            df_norm = normalize_df(df, args.radius_arcsec)
-            df_one = collapse_per_row_id(df_norm)
-        except Exception as e:
-            print(f"[WARN] Skipping {f}: {e}", file=sys.stderr)
-            continue
-
-        rows_in += df_norm.shape[0]
-        groups_written += df_one.shape[0]
-
-        tbl = pa.Table.from_pandas(df_one, schema=schema, preserve_index=False)
-        writer.write_table(tbl)
-
-        if i % 200 == 0:
-            print(f"[INFO] {i} files processed; raw_rows={rows_in}; unique_row_id_rows={groups_written}")
-
+    workers = args.workers if args.workers > 0 else min(8, os.cpu_count() or 1)
+    print(f"[INFO] {len(inputs)} closest files; workers={workers}")
+
+    # Files are independent: parse/collapse them in worker processes (one Arrow
+    # thread each to avoid oversubscription). map() keeps input order, so the
+    # sidecar is byte-for-byte the same as a --workers 1 run.
+    pool = (ProcessPoolExecutor(max_workers=workers, initializer=pa.set_cpu_count, initargs=(1,))
+            if workers > 1 else nullcontext())
+    with pool as ex:
+        results = (ex.map(load_one, inputs, repeat(args.radius_arcsec), chunksize=4)
+                   if ex is not None else map(load_one, inputs, repeat(args.radius_arcsec)))
+        for i, (f, n_in, df_one, err) in enumerate(results, 1):
+            if err is not None:
+                print(f"[WARN] Skipping {f}: {err}", file=sys.stderr)
+                continue
+
+            rows_in += n_in
+            groups_written += df_one.num_rows
+
+            tbl = df_one.cast(schema)
+            pending.append(tbl)
+            pending_rows += tbl.num_rows
+            if pending_rows >= ROW_GROUP_ROWS:
+                writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_ROWS)
+                pending, pending_rows = [], 0
+
+            if i % 200 == 0:
+                print(f"[INFO] {i} files processed; raw_rows={rows_in}; unique_row_id_rows={groups_written}")
+
+    if pending:
+        writer.write_table(pa.concat_tables(pending), row_group_size=ROW_GROUP_ROWS)
     writer.close()
-    (out_root / "_SUCCESS").write_text("ok\n", encoding="utf-8")
+    # The sidecar must be on disk before _SUCCESS; the marker rename (plus the
+    # parent-dir fsync, which also covers the sidecar's entry) is the commit point.
+    fsync_path(out_path)
+    atomic_write_text(out_root / "_SUCCESS", "ok\n")
     print(f"[OK] Sidecar written: {out_path} (unique_row_id_rows={groups_written})")
     print(f"[OK] Marker: {out_root / '_SUCCESS'}")
 
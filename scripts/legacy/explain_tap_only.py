@@ -17,56 +17,134 @@ Usage:
     --cntrs ./data/local-cats/tmp/positions/aws_compare_out/compare_chunk00005.tap_only_by_cntr.csv \
     --radius 5
 """
-import argparse, math, numpy as np, pandas as pd, pyarrow as pa
+import argparse, math, operator, numpy as np, pandas as pd, pyarrow as pa
 import pyarrow.dataset as pds, pyarrow.compute as pc
 from pyarrow import fs as pafs
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from functools import reduce
 
 def arcsec2rad(a): return a / 206264.806
 
-def bbox(ra0, dec0, r_arcsec):
+def make_bbox(r_arcsec):
+    """
+    Return bbox(ra0, dec0) -> dataset filter covering the r_arcsec cone.
+    The radius is folded once; the RA half-width is ddeg/cos(dec0) so the box
+    contains the cone at any declination, and the seam branch is only taken near RA 0/360.
+    """
     ddeg = math.degrees(arcsec2rad(r_arcsec))
     ra = pc.field('ra'); dec = pc.field('dec')
-    ra_min, ra_max = (ra0 - ddeg) % 360.0, (ra0 + ddeg) % 360.0
-    if ra_min <= ra_max:
-        fra = (ra >= ra_min) & (ra <= ra_max)
-    else:
-        fra = (ra >= ra_min) | (ra <= ra_max)
-    fdec = (dec >= dec0 - ddeg) & (dec <= dec0 + ddeg)
-    return fra & fdec
+
+    def bbox(ra0, dec0):
+        fdec = (dec >= dec0 - ddeg) & (dec <= dec0 + ddeg)
+        if abs(dec0) + ddeg >= 90.0:
+            return fdec  # cone touches a pole: every RA
+        dra = ddeg / math.cos(math.radians(abs(dec0) + ddeg))
+        if ra0 - dra < 0.0 or ra0 + dra >= 360.0:
+            fra = (ra >= (ra0 - dra) % 360.0) | (ra <= (ra0 + dra) % 360.0)
+        else:
+            fra = (ra >= ra0 - dra) & (ra <= ra0 + dra)
+        return fra & fdec
+    return bbox
+
+def moon_masked_keep(schema: pa.Schema):
+    """
+    Pushdown predicate keeping 0-like moon_masked ('00'/'0' as text, 0 as a number),
+    typed against the leaf schema so no full-column casts are needed after the read.
+    Returns None when the type is unexpected (caller normalizes post-read).
+    """
+    mm = pc.field('moon_masked')
+    t = schema.field('moon_masked').type
+    if pa.types.is_string(t) or pa.types.is_large_string(t):
+        return mm.isin(pa.array(['00', '0']))
+    if pa.types.is_integer(t) or pa.types.is_floating(t):
+        return mm == 0
+    return None
 
 def years_all(): return [f"year{i}" for i in range(1,12)] + ["addendum"]
 
-def leaf(year, k5):
-    k0 = k5 // 1024
+def year_root(year):
     return f"nasa-irsa-wise/wise/neowiser/catalogs/p1bs_psd/healpix_k5/{year}/" \
-           f"neowiser-healpix_k5-{year}.parquet/healpix_k0={k0}/healpix_k5={k5}/"
+           f"neowiser-healpix_k5-{year}.parquet/"
+
+def leaf_filter(k5):
+    # hive partition keys; Arrow prunes the year dataset to this one leaf
+    return (pc.field('healpix_k0') == k5 // 1024) & (pc.field('healpix_k5') == k5)
 
-def k5_index(ra_deg, dec_deg):
+# typed hive keys: the leaf filter compares ints, and discovery does not open any file
+K5_PARTITIONING = pds.partitioning(
+    pa.schema([('healpix_k0', pa.int32()), ('healpix_k5', pa.int32())]), flavor='hive')
+
+def open_year(fs, year, cache):
+    """One dataset per year, memoized across cntrs (None if the year is missing)."""
+    if year not in cache:
+        try:
+            cache[year] = pds.dataset(year_root(year), format='parquet', filesystem=fs,
+                                      partitioning=K5_PARTITIONING)
+        except Exception:
+            cache[year] = None
+    return cache[year]
+
+def k5_index(ra_deg, dec_deg) -> np.ndarray:
+    """Nested k5 (nside=32) pixels for arrays of RA/Dec in degrees, in one vectorized call."""
+    ra_deg = np.asarray(ra_deg, dtype=np.float64) % 360.0
+    dec_deg = np.asarray(dec_deg, dtype=np.float64)
     # Try healpy, then astropy_healpix, then hpgeom
     try:
         import healpy as hp
         nside = 2**5
         theta = np.deg2rad(90.0 - dec_deg)
-        phi   = np.deg2rad(ra_deg % 360.0)
-        return int(hp.ang2pix(nside, theta, phi, nest=True))
+        phi   = np.deg2rad(ra_deg)
+        return np.asarray(hp.ang2pix(nside, theta, phi, nest=True), dtype=np.int64)
     except Exception:
         pass
     try:
         from astropy_healpix import HEALPix
+        import astropy.units as u
         nside = 2**5
-        return int(HEALPix(nside=nside, order='nested').lonlat_to_healpix(
-            np.deg2rad(ra_deg), np.deg2rad(dec_deg)))
+        return np.asarray(HEALPix(nside=nside, order='nested').lonlat_to_healpix(
+            ra_deg * u.deg, dec_deg * u.deg), dtype=np.int64)
     except Exception:
         pass
     try:
-        import hpgeom as hpg, healpy as hp
-        th, ph = hpg.lonlat_to_thetaphi(ra_deg, dec_deg, degrees=True)
-        return int(hpg.thetaphi_to_healpix(th, ph, order=5, nest=True)) \
-               if hasattr(hpg,"thetaphi_to_healpix") else int(hp.ang2pix(2**5, th, ph, nest=True))
+        import hpgeom as hpg
+        return np.asarray(hpg.angle_to_pixel(2**5, ra_deg, dec_deg, nest=True, lonlat=True, degrees=True),
+                          dtype=np.int64)
     except Exception:
         pass
     raise RuntimeError("HEALPix indexing failed.")
 
+def scan_leaf(ds, k5, members, bbox, gates) -> dict:
+    """
+    Read one k5 leaf once for all (cntr, ra0, dec0) members (union of their bboxes),
+    then check each member against its own bbox in memory.
+    Returns {cntr: rows in that cntr's bbox} for members found in the leaf.
+    """
+    mm_keep = moon_masked_keep(ds.schema)
+    boxes = reduce(operator.or_, [bbox(ra0, dec0) for _, ra0, dec0 in members])
+    filt = leaf_filter(k5) & boxes & gates
+    # presence + per-cntr bbox only need cntr/ra/dec (moon_masked just for the fallback)
+    cols = ['cntr','ra','dec'] + (['moon_masked'] if mm_keep is None else [])
+    tbl = ds.to_table(filter=filt if mm_keep is None else filt & mm_keep, columns=cols)
+    if tbl.num_rows == 0:
+        return {}
+    if mm_keep is None:
+        # Post-read moon_masked normalization (unexpected type): keep 0-like values only
+        mm = tbl['moon_masked']
+        mm_str = pc.cast(mm, pa.utf8(), safe=False)
+        keep = pc.is_in(mm_str, value_set=pa.array(['00', '0']))
+        try:
+            keep = pc.or_(keep, pc.equal(pc.cast(mm, pa.int64(), safe=False), pa.scalar(0, pa.int64())))
+        except Exception:
+            pass
+        tbl = tbl.filter(keep)
+    out = {}
+    for cn, ra0, dec0 in members:
+        sub = tbl.filter(bbox(ra0, dec0)) if len(members) > 1 else tbl
+        if sub.num_rows and pc.any(pc.equal(sub['cntr'], cn)).as_py():
+            out[cn] = sub.num_rows
+    return out
+
 def parse_cntrs_arg(arg: str) -> list:
     """
     Return a list of int cntrs from a string or a CSV file path.
@@ -125,57 +203,61 @@ def main():
     years = [p.strip() for p in a.years.replace(',',' ').split() if p.strip()] if a.years else years_all()
 
     fs = pafs.S3FileSystem(anonymous=True, region='us-west-2')
-    # TAP-equivalent gates (numeric-only pushdown; moon_masked normalization handled post-read if needed)
+    # TAP-equivalent gates (numeric pushdown; moon_masked predicate is typed per leaf)
     gates = ((pc.field('qual_frame') > 0) &
              (pc.field('qi_fact')    > 0.0) &
              (pc.field('saa_sep')    > 0.0) &
              (pc.field('w1snr')      >= 5.0) &
              (pc.field('mjd')        <= 59198.0))
+    year_to_ds = {}
+    bbox = make_bbox(a.radius)
 
+    # Seeds grouped by k5 leaf, so co-located cntrs share one read per year
+    # First TAP row per cntr gives its seed; all k5 pixels come from one vectorized call
+    first = tap.drop_duplicates('cntr').set_index('cntr')
+    known = [cn for cn in cntrs if cn in first.index]
+    ra_all = first.loc[known, 'in_ra'].to_numpy(dtype=np.float64) % 360.0
+    dec_all = first.loc[known, 'in_dec'].to_numpy(dtype=np.float64)
+    k5_all = k5_index(ra_all, dec_all) if known else np.empty(0, dtype=np.int64)
+    seed_of = {cn: (float(r), float(d), int(k)) for cn, r, d, k in zip(known, ra_all, dec_all, k5_all)}
+
+    seeds, groups = [], defaultdict(list)
     for cn in cntrs:
-        rows = tap.loc[tap['cntr'] == cn, ['in_ra','in_dec','cntr']]
-        if rows.empty:
+        if cn not in seed_of:
+            seeds.append((cn, None, None, None))
+            continue
+        ra0, dec0, k5 = seed_of[cn]
+        seeds.append((cn, ra0, dec0, k5))
+        groups[k5].append((cn, ra0, dec0))
+
+    def scan_year(yr):
+        ds = open_year(fs, yr, year_to_ds)
+        if ds is None:
+            return {}
+        return {k5: scan_leaf(ds, k5, members, bbox, gates) for k5, members in groups.items()}
+
+    # Years are independent S3 reads (IO-bound; Arrow releases the GIL), so overlap them
+    with ThreadPoolExecutor(max_workers=max(1, min(12, len(years)))) as ex:
+        per_year = list(ex.map(scan_year, years))
+
+    found = defaultdict(list)   # cntr -> [(year, rows in its bbox)], in year order
+    for yr, by_k5 in zip(years, per_year):
+        for hits in by_k5.values():
+            for cn, n in hits.items():
+                found[cn].append((yr, n))
+
+    for cn, ra0, dec0, k5 in seeds:
+        if k5 is None:
             print(f"\ncntr={cn}: not present in TAP input rows (skipping).")
             continue
-        ra0 = float(rows['in_ra'].iloc[0]) % 360.0
-        dec0 = float(rows['in_dec'].iloc[0])
-        k5 = k5_index(ra0, dec0)
         print(f"\ncntr={cn} seed=({ra0:.9f},{dec0:.9f}) k5={k5}")
-
-        hits = 0
-        for yr in years:
-            path = leaf(yr, k5)
-            try:
-                ds = pds.dataset(path, format='parquet', filesystem=fs,
-                                 partitioning='hive', exclude_invalid_files=True)
-            except Exception:
-                # Missing leaf is expected for some years
-                continue
-            tbl = ds.to_table(filter=bbox(ra0, dec0, a.radius) & gates,
-                              columns=['cntr','ra','dec','mjd','w1snr','w2snr','moon_masked'])
-            if tbl.num_rows == 0:
-                continue
-            # Post-read moon_masked normalization: keep 0-like values only
-            mm = tbl['moon_masked']
-            mm_str = pc.cast(mm, pa.utf8(), safe=False)
-            keep = pc.equal(mm_str, pa.scalar("00"))
-            keep = pc.or_(keep, pc.equal(mm_str, pa.scalar("0")))
-            try:
-                keep = pc.or_(keep, pc.equal(pc.cast(mm, pa.int64(), safe=False), pa.scalar(0, pa.int64())))
-            except Exception:
-                pass
-            tbl = tbl.filter(keep)
-            if tbl.num_rows == 0:
-                continue
-            df = tbl.to_pandas()
-            present = (df['cntr'] == cn).any()
-            if present:
-                hits += 1
-                print(f"  {yr}: present (rows={len(df)})")
-        if hits == 0:
+        hits = found.get(cn, [])
+        for yr, n in hits:
+            print(f"  {yr}: present (rows={n})")
+        if not hits:
             print("  not present in any year/addendum leaf under gates+bbox")
         else:
-            print(f"  present in {hits} year leaf(s)")
+            print(f"  present in {len(hits)} year leaf(s)")
 
     # Also show which TAP-only cntrs appear in AWS closest (sanity)
     aws_cntrs = set(aws['cntr'].tolist()) if 'cntr' in aws.columns else set()
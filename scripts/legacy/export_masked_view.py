@@ -2,31 +2,66 @@
 # -*- coding: utf-8 -*-
 """
 export_masked_view.py (Post 1.6) — TWO-PHASE, OUT-OF-CORE, COMPOSITE-KEY JOIN
-v2.3: Phase 2 writes per (ra_bin, dec_bin) chunk to bound memory and avoid global COPY OOMs.
+v2.4: Phase 2 is one partitioned COPY (single master scan), or an Arrow-partitioned stream of the
+      same query (--phase2 arrow); the v2.3 per-(ra_bin, dec_bin) loop
+      is kept behind --phase2 bins for hosts where the partitioned write still runs out of memory.
 
-Phase 1 (narrow): (tile_id, NUMBER, coords) -> coarse dedupe -> join IR -> mask -> survivor KEYS ONLY
-Phase 2 (wide):  for each DISTINCT (ra_bin, dec_bin) in survivors_keys:
-                   read that bin from master -> semi-join with keys of that bin -> write one parquet file
-                   to out-dataset-dir/ra_bin=<…>/dec_bin=<…>/part-<…>.parquet
+Phase 1 (narrow): (tile_id, NUMBER, coords) -> coarse dedupe (GROUP BY grid cell) -> join IR -> mask -> survivor KEYS ONLY
+Phase 2 (wide):  read survivor bins of master once -> SEMI JOIN with survivors_keys -> COPY ... PARTITION_BY (ra_bin, dec_bin)
+                   to out-dataset-dir/ra_bin=<…>/dec_bin=<…>/part-<n>.parquet
+                 (--phase2 bins: one COPY per DISTINCT (ra_bin, dec_bin), file part-<ra_bin>-<dec_bin>.parquet)
+
+Output schema by --phase2 mode: copy and bins store ra_bin/dec_bin both in the directory names and
+in every file body. arrow stores them in the directory names only (pyarrow.dataset always drops
+hive partition columns from the files), so its output must be read with hive partitioning
+(DuckDB read_parquet(..., hive_partitioning=1), pyarrow.dataset(..., partitioning="hive")); a
+reader that opens single files without it sees no ra_bin/dec_bin columns.
 
 CLI:
   --input-parquet <dir>        optical master parquet root (required)
   --irflags-parquet <file>     IR flags parquet keyed by (tile_id, NUMBER) (required)
   --mask "<expr>"              boolean expression over derived exclude_* (required)
   --dedupe-tol-arcsec <f>      approx dedupe grid (default 0.5")
-  --out-dataset-dir <dir>      partitioned parquet dataset directory (required)
+  --out-dataset-dir <dir>      partitioned parquet dataset directory (required); partitions from a
+                               previous run (ra_bin=*) are removed before phase 2
   --ra-col / --dec-col         optional coordinate overrides
   --duckdb-threads <int>       default 4 (use 2–6 if memory is tight)
+  --phase1-buckets <int>       split the phase-1 dedupe into N hash(cell) buckets (default 1)
+  --phase2 copy|arrow|bins     single partitioned COPY (default), a DuckDB->Arrow record-batch stream
+                               written by pyarrow.dataset (hive dirs, no ra_bin/dec_bin in the files),
+                               or the per-bin loop (lowest memory)
+  --phase2-workers <int>       --phase2 bins: write this many bins concurrently (default 1); the workers
+                               share the --duckdb-threads pool, so keep workers x threads ~ cores
+  --small-survivors <int>      at or below this many survivor keys, --phase2 bins opens only the surviving
+                               tiles' part-<tile_id>.parquet files per bin (default 100000)
+  --compact-dir <dir>          if the master's median part file is < --compact-below-mb (default 16),
+                               compact it once into <dir> (large bin-partitioned files) and read that
+  --output-cols <a,b,...>      write only these master columns (+ tile_id, NUMBER, ra_bin, dec_bin);
+                               default: all columns
+  --compression <codec>        parquet codec for the output files: snappy|zstd|lz4 (default zstd)
+  --compression-level <int>    zstd level for the output files (default: DuckDB's)
+  --row-group-size <int>       rows per output row group (default 1000000)
+  --partition-flush-rows <int> rows a thread buffers per partition before flushing in --phase2 copy
+                               (default 100000; DuckDB's own 524288 is ~10% faster but needs more memory)
   --duckdb-mem <str>           "auto" or "10GB" etc. (default: "auto")
   --temp-dir <dir>             spill directory (default: /tmp/vasco_duckdb_tmp)
-  --use-file-db                store DuckDB DB on disk
+  --use-file-db                store DuckDB DB on disk; phase-1 inputs are cached there as native
+                               tables and reused while the input files are unchanged
   --db-path <file>             explicit DB path (defaults to <temp-dir>/export_tmp.duckdb if --use-file-db)
 """
 
-import argparse, os, re, sys
+import argparse, glob, hashlib, os, re, shutil, statistics, sys, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import List, Optional, Tuple
 
+# ---- Make scripts/ importable without requiring it to be a Python package ----
+SCRIPTS_DIR = Path(__file__).resolve().parents[1]
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+from utils_duckdb_sql import packed_grid_key, parquet_copy_options, sql_quote, typed
+
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("--input-parquet", required=True)
@@ -37,6 +72,17 @@ def parse_args():
     p.add_argument("--ra-col", default=None)
     p.add_argument("--dec-col", default=None)
     p.add_argument("--duckdb-threads", type=int, default=4)
+    p.add_argument("--phase1-buckets", type=int, default=1)
+    p.add_argument("--phase2", choices=["copy", "arrow", "bins"], default="copy")
+    p.add_argument("--phase2-workers", type=int, default=1)
+    p.add_argument("--small-survivors", type=int, default=100_000)
+    p.add_argument("--compact-dir", default="")
+    p.add_argument("--compact-below-mb", type=float, default=16.0)
+    p.add_argument("--output-cols", default="")
+    p.add_argument("--compression", choices=["snappy", "zstd", "lz4"], default="zstd")
+    p.add_argument("--compression-level", type=int, default=None)
+    p.add_argument("--row-group-size", type=int, default=1_000_000)
+    p.add_argument("--partition-flush-rows", type=int, default=100_000)
     p.add_argument("--duckdb-mem", default="auto")
     p.add_argument("--temp-dir", default="/tmp/vasco_duckdb_tmp")
     p.add_argument("--use-file-db", action="store_true")
@@ -44,9 +90,6 @@ def parse_args():
     a = p.parse_args()
     return a
 
-def sql_quote(s: str) -> str:
-    return "'" + str(s).replace("'", "''") + "'"
-
 def pick_coords(cols: List[str], ra_override: Optional[str], dec_override: Optional[str]) -> Tuple[str, str]:
     if ra_override and dec_override and ra_override in cols and dec_override in cols:
         return ra_override, dec_override
@@ -73,25 +116,82 @@ def get_system_mem_approx() -> int:
         pass
     return 16 * 1024**3
 
-def normalize_mask_for_phase1(mask: str) -> str:
+IR_EXCLUDE_SQL = "(NOT COALESCE(i.has_ir_match, FALSE))"
+SOURCE_EXCLUDES = ("exclude_hpm", "exclude_skybot", "exclude_supercosmos", "exclude_spike",
+                   "exclude_morphology_bad")
+MASK_TOKEN_RE = re.compile(r"\b[A-Za-z_]\w*\b")
+
+def normalize_mask_for_phase1(mask: str, ir_sql: str = IR_EXCLUDE_SQL) -> str:
     """
     Phase-1 derives only IR-based exclude; source-side booleans are absent.
-    Map:
+    Map (one tokenizing pass; whole identifiers only, so exclude_ir_strict_x is left alone):
       exclude_ir_strict -> (NOT COALESCE(i.has_ir_match, FALSE))
       exclude_hpm/skybot/supercosmos/spike/morphology_bad -> FALSE
     """
-    m = mask
-    repls = {
-        r"\bexclude_ir_strict\b": "(NOT COALESCE(i.has_ir_match, FALSE))",
-        r"\bexclude_hpm\b": "FALSE",
-        r"\bexclude_skybot\b": "FALSE",
-        r"\bexclude_supercosmos\b": "FALSE",
-        r"\bexclude_spike\b": "FALSE",
-        r"\bexclude_morphology_bad\b": "FALSE",
-    }
-    for pat, rep in repls.items():
-        m = re.sub(pat, rep, m)
-    return m
+    repls = dict.fromkeys(SOURCE_EXCLUDES, "FALSE")
+    repls["exclude_ir_strict"] = ir_sql
+    return MASK_TOKEN_RE.sub(lambda t: repls.get(t.group(0), t.group(0)), mask)
+
+def ir_join_kind(con, mask: str) -> Optional[str]:
+    """
+    Truth-table the phase-1 mask over its only free input, exclude_ir_strict.
+    Returns "ANTI" if the mask is equivalent to exclude_ir_strict, "SEMI" if it is equivalent to
+    NOT exclude_ir_strict, else None (keep the LEFT JOIN + WHERE plan).
+    """
+    if "exclude_ir_strict" not in set(MASK_TOKEN_RE.findall(mask)):
+        return None
+    try:
+        on, off = con.execute(
+            f"SELECT ({normalize_mask_for_phase1(mask, 'TRUE')}),"
+            f" ({normalize_mask_for_phase1(mask, 'FALSE')});").fetchone()
+    except Exception:
+        return None  # references something other than the exclude_* flags
+    return {(True, False): "ANTI", (False, True): "SEMI"}.get((on, off))
+
+def inputs_fingerprint(files: List[str], *params) -> str:
+    """sha1 over every input file's (path, size, mtime) plus the projection parameters."""
+    h = hashlib.sha1(repr(params).encode())
+    for f in files:
+        st = os.stat(f)
+        h.update(f"{f}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+def clear_dataset(out_ds: Path) -> None:
+    """
+    Remove a previous run's ra_bin=*/dec_bin=* partitions from out_ds. The phase-2 modes name
+    their files differently (part-<n> vs part-<ra_bin>-<dec_bin>) and a re-run may drop bins,
+    so writing over old partitions would leave duplicate rows or stale bins behind.
+    """
+    for d in glob.glob(os.path.join(glob.escape(out_ds.as_posix()), "ra_bin=*")):
+        shutil.rmtree(d)
+
+def compact_master(con, src_root: Path, dst_root: Path, below_mb: float, row_group_size: int) -> Path:
+    """
+    If the master's median part file is under below_mb, copy it once into dst_root as large
+    (ra_bin, dec_bin)-partitioned files and return dst_root; otherwise return src_root.
+    The copy is reused while the source files are unchanged (fingerprint in _compacted_from.sha1).
+    """
+    files = sorted(glob.glob(os.path.join(src_root, "**", "*.parquet"), recursive=True))
+    if not files or statistics.median(os.path.getsize(f) for f in files) >= below_mb * 1024**2:
+        return src_root
+    fp = inputs_fingerprint(files)
+    stamp = dst_root / "_compacted_from.sha1"
+    if stamp.is_file() and stamp.read_text().strip() == fp:
+        print(f"[INFO] Reusing compacted master: {dst_root}")
+        return dst_root
+    if stamp.is_file():
+        shutil.rmtree(dst_root)  # stale copy of ours; bins may have disappeared from the source
+    elif dst_root.exists() and any(dst_root.iterdir()):
+        raise SystemExit(f"[ERROR] --compact-dir {dst_root} is not empty and was not written by this script.")
+    print(f"[INFO] Compacting {len(files)} small master files into {dst_root}")
+    dst_root.mkdir(parents=True, exist_ok=True)
+    con.execute(f"""
+        COPY (SELECT * FROM read_parquet([{", ".join(sql_quote(f) for f in files)}], hive_partitioning=1))
+        TO {sql_quote(dst_root.as_posix())}
+        (FORMAT PARQUET, PARTITION_BY (ra_bin, dec_bin), ROW_GROUP_SIZE {int(row_group_size)});
+    """)
+    stamp.write_text(fp + "\n")
+    return dst_root
 
 def main():
     a = parse_args()
@@ -128,15 +228,29 @@ def main():
         con.execute(f"PRAGMA memory_limit={sql_quote(a.duckdb_mem)};")
 
     # Inputs & schema
-    opt_glob = os.path.join(a.input_parquet, "**", "*.parquet")
+    opt_root = Path(a.input_parquet)
+    if a.compact_dir:
+        opt_root = compact_master(con, opt_root, Path(a.compact_dir).resolve(),
+                                  a.compact_below_mb, a.row_group_size)
+    opt_glob = os.path.join(opt_root, "**", "*.parquet")
     ir_path  = a.irflags_parquet
+    # List the master once: both phases' reads take this file list as a literal instead of each
+    # re-globbing the tree (DuckDB expands a glob every time a query over it is planned)
+    opt_files = sorted(glob.glob(opt_glob, recursive=True))
+    if not opt_files:
+        raise SystemExit(f"[ERROR] No parquet files under {opt_root}")
+    opt_src = "[" + ", ".join(sql_quote(f) for f in opt_files) + "]"
 
-    opt_cols = [r[0] for r in con.execute(
-        f"DESCRIBE SELECT * FROM read_parquet({sql_quote(opt_glob)}, hive_partitioning=1) LIMIT 0;"
-    ).fetchall()]
-    ir_cols  = [r[0] for r in con.execute(
+    # Schema from one part file: DuckDB takes a list's schema from its first file anyway.
+    # The hive keys still come from that file's path.
+    opt_types = {r[0]: r[1] for r in con.execute(
+        f"DESCRIBE SELECT * FROM read_parquet({sql_quote(opt_files[0])}, hive_partitioning=1) LIMIT 0;"
+    ).fetchall()}
+    opt_cols = list(opt_types)
+    ir_types = {r[0]: r[1] for r in con.execute(
         f"DESCRIBE SELECT * FROM read_parquet({sql_quote(ir_path)}) LIMIT 0;"
-    ).fetchall()]
+    ).fetchall()}
+    ir_cols = list(ir_types)
 
     if not ("tile_id" in opt_cols and "NUMBER" in opt_cols):
         raise SystemExit("[ERROR] Optical master must contain tile_id and NUMBER.")
@@ -144,92 +258,272 @@ def main():
         raise SystemExit("[ERROR] IR flags must contain tile_id and NUMBER.")
 
     ra_col, dec_col = pick_coords(opt_cols, a.ra_col, a.dec_col)
+    # Phase-2 projection: all master columns, or --output-cols plus the join keys and bins, so the
+    # wide scan reads only those column chunks
+    out_select = "o.*"
+    if a.output_cols:
+        want = [c.strip() for c in a.output_cols.split(",") if c.strip()]
+        missing = [c for c in want if c not in opt_types]
+        if missing:
+            raise SystemExit(f"[ERROR] --output-cols not in optical master: {missing}")
+        out_select = ", ".join(f"o.{c}" for c in dict.fromkeys(want + ["tile_id", "NUMBER", "ra_bin", "dec_bin"]))
     grid = float(a.dedupe_tol_arcsec) / 3600.0
 
     # Phase 1 — narrow projection, dedupe, IR join, mask -> survivors_keys
     con.execute(f"""
-        CREATE VIEW optical_narrow AS
-        SELECT tile_id::VARCHAR AS tile_id,
-               NUMBER::BIGINT   AS NUMBER,
-               {ra_col}::DOUBLE AS ra,
-               {dec_col}::DOUBLE AS dec,
-               ra_bin::BIGINT   AS ra_bin,
-               dec_bin::BIGINT  AS dec_bin
-        FROM read_parquet({sql_quote(opt_glob)}, hive_partitioning=1)
+        CREATE OR REPLACE TEMP VIEW optical_narrow AS
+        SELECT {typed("tile_id", opt_types, "VARCHAR")} AS tile_id,
+               {typed("NUMBER", opt_types, "BIGINT")} AS NUMBER,
+               {typed(ra_col, opt_types, "DOUBLE")} AS ra,
+               {typed(dec_col, opt_types, "DOUBLE")} AS dec,
+               {typed("ra_bin", opt_types, "BIGINT")} AS ra_bin,
+               {typed("dec_bin", opt_types, "BIGINT")} AS dec_bin
+        FROM read_parquet({opt_src}, hive_partitioning=1)
         WHERE {ra_col} IS NOT NULL AND {dec_col} IS NOT NULL;
     """)
     con.execute(f"""
-        CREATE VIEW ir AS
-        SELECT tile_id::VARCHAR AS tile_id,
-               NUMBER::BIGINT   AS NUMBER,
-               has_ir_match::BOOLEAN AS has_ir_match,
-               dist_arcsec::DOUBLE   AS dist_arcsec
+        CREATE OR REPLACE TEMP VIEW ir_parquet AS
+        SELECT {typed("tile_id", ir_types, "VARCHAR")} AS tile_id,
+               {typed("NUMBER", ir_types, "BIGINT")} AS NUMBER,
+               {typed("has_ir_match", ir_types, "BOOLEAN")} AS has_ir_match,
+               {typed("dist_arcsec", ir_types, "DOUBLE")} AS dist_arcsec
         FROM read_parquet({sql_quote(ir_path)});
     """)
 
     mask_phase1 = normalize_mask_for_phase1(a.mask)
-    con.execute(f"""
-        CREATE TEMP VIEW base AS
+    base_sql = f"""
         SELECT o.tile_id AS _tile_id, o.NUMBER AS _NUMBER,
                o.ra, o.dec, o.ra_bin, o.dec_bin,
-               CAST(round(o.ra/{grid}) AS BIGINT)  AS dk_ra,
-               CAST(round(o.dec/{grid}) AS BIGINT) AS dk_dec
-        FROM optical_narrow o;
-    """)
-    con.execute("""
-        CREATE TEMP VIEW ranked AS
-        SELECT *,
-               row_number() OVER (PARTITION BY dk_ra, dk_dec ORDER BY _tile_id, _NUMBER) AS rn
-        FROM base;
-    """)
+               {packed_grid_key("o.ra", "o.dec", grid)} AS dk
+        FROM optical_narrow o"""
+    if a.use_file_db:
+        # Keep the narrow projection and IR flags as native tables in the file DB; later runs
+        # (e.g. other masks) over unchanged inputs skip the Parquet decode for phase 1.
+        fp = inputs_fingerprint(opt_files + [ir_path], ra_col, dec_col, grid)
+        con.execute("CREATE TABLE IF NOT EXISTS export_cache_meta (fingerprint VARCHAR);")
+        cached = con.execute("SELECT fingerprint FROM export_cache_meta;").fetchone()
+        if cached and cached[0] == fp:
+            print("[INFO] Phase 1 inputs unchanged; reusing cached tables in the file DB")
+        else:
+            print("[INFO] Building phase 1 cache tables in the file DB")
+            con.execute(f"CREATE OR REPLACE TABLE optical_cache AS {base_sql};")
+            con.execute("CREATE OR REPLACE TABLE ir_cache AS SELECT * FROM ir_parquet;")
+            con.execute("DELETE FROM export_cache_meta;")
+            con.execute(f"INSERT INTO export_cache_meta VALUES ({sql_quote(fp)});")
+        con.execute("CREATE OR REPLACE TEMP VIEW base AS SELECT * FROM optical_cache;")
+        con.execute("CREATE OR REPLACE TEMP VIEW ir AS SELECT * FROM ir_cache;")
+    else:
+        con.execute(f"CREATE OR REPLACE TEMP VIEW base AS {base_sql};")
+        con.execute("CREATE OR REPLACE TEMP VIEW ir AS SELECT * FROM ir_parquet;")
+    # one hash aggregate per grid cell (no partitioned sort); the (tile_id, NUMBER) minimum
+    # is the row the old row_number() window ranked first. The kept columns ride along in one
+    # min(struct) (ordered by its leading tile_id, NUMBER fields), a single aggregate state per
+    # cell instead of one arg_min per column.
+    # --phase1-buckets N > 1 splits it into N independent aggregates UNION ALL'd together. Buckets
+    # are hash(dk), not tile_id: duplicates of one sky position sit on different (overlapping) tiles.
+    nb = max(1, int(a.phase1_buckets))
+    dedupe_sql = """
+        SELECT k._tile_id, k._NUMBER, k.ra_bin, k.dec_bin
+        FROM (
+          SELECT min(struct_pack(_tile_id, _NUMBER, ra_bin, dec_bin)) AS k
+          FROM base {where}
+          GROUP BY dk
+        )"""
+    buckets = [dedupe_sql.format(where="")] if nb == 1 else \
+              [dedupe_sql.format(where=f"WHERE hash(dk) % {nb} = {k}") for k in range(nb)]
+    con.execute("CREATE TEMP VIEW deduped AS" + "\n        UNION ALL".join(buckets) + ";")
+    # A mask that reduces to (NOT) exclude_ir_strict needs no nullable IR columns: anti/semi join
+    # against the has_ir_match keys only. Anything else keeps the LEFT JOIN + WHERE plan.
+    join_kind = ir_join_kind(con, a.mask)
+    # (the LEFT JOIN keeps a key if ANY of its IR rows lacks a match, so the anti side is the keys
+    # whose rows ALL match: the matched keys minus any key with an unmatched/NULL row, two filtered
+    # hash probes rather than a GROUP BY over all of IR; the semi side is the keys with at least
+    # one match)
+    ir_keys = {
+        "ANTI": "SELECT p.tile_id, p.NUMBER FROM (SELECT tile_id, NUMBER FROM ir WHERE has_ir_match) p"
+                " ANTI JOIN (SELECT tile_id, NUMBER FROM ir WHERE NOT COALESCE(has_ir_match, FALSE)) n"
+                " ON p.tile_id = n.tile_id AND p.NUMBER = n.NUMBER",
+        "SEMI": "SELECT tile_id, NUMBER FROM ir WHERE has_ir_match",
+    }
+    if join_kind:
+        ir_join = (f"{join_kind} JOIN ({ir_keys[join_kind]}) i"
+                   f" ON r._tile_id=i.tile_id AND r._NUMBER=i.NUMBER")
+    else:
+        ir_join = (f"LEFT JOIN ir i ON r._tile_id=i.tile_id AND r._NUMBER=i.NUMBER\n"
+                   f"        WHERE ({mask_phase1})")
+    print(f"[INFO] Phase 1 IR join: {join_kind or 'LEFT'}")
     con.execute(f"""
         CREATE TEMP TABLE survivors_keys AS
         SELECT r._tile_id AS tile_id,
                r._NUMBER  AS NUMBER,
                r.ra_bin, r.dec_bin
-        FROM ranked r
-        LEFT JOIN ir i ON r._tile_id=i.tile_id AND r._NUMBER=i.NUMBER
-        WHERE r.rn=1 AND ({mask_phase1});
+        FROM deduped r
+        {ir_join};
     """)
-    # small index helps bin lookups
-    con.execute("CREATE INDEX survivors_idx ON survivors_keys(ra_bin, dec_bin);")
+    # Hand the keys to phase 2 as a registered Arrow table: the phase-2 semi-join builds its
+    # hash table straight from it (an ART index is never used for hash equi-joins)
+    res = con.execute("SELECT tile_id, NUMBER, ra_bin, dec_bin FROM survivors_keys;")
+    survivors_arrow = (getattr(res, "to_arrow_table", None) or res.fetch_arrow_table)()  # newer duckdb renamed it
+    con.execute("DROP TABLE survivors_keys;")
+    con.register("survivors_keys", survivors_arrow)
 
-    # Phase 2 — write dataset per (ra_bin, dec_bin) chunk
-    bins = con.execute("SELECT DISTINCT ra_bin, dec_bin FROM survivors_keys ORDER BY ra_bin, dec_bin;").fetchall()
-    if not bins:
+    # Phase 2 — write the (ra_bin, dec_bin)-partitioned dataset
+    survivor_bins = con.execute(
+        "SELECT DISTINCT ra_bin, dec_bin FROM survivors_keys ORDER BY ra_bin, dec_bin;").fetchall()
+    clear_dataset(out_ds)
+    if not survivor_bins:
         print("[OK] No survivors after mask; wrote empty dataset (nothing to do).")
         sys.exit(0)
 
     # Helper view for master read: define once
-    con.execute(f"CREATE VIEW optical_wide AS SELECT * FROM read_parquet({sql_quote(opt_glob)}, hive_partitioning=1);")
+    optical_wide_sql = f"CREATE OR REPLACE TEMP VIEW optical_wide AS SELECT * FROM read_parquet({opt_src}, hive_partitioning=1);"
+    con.execute(optical_wide_sql)
+    parquet_opts = parquet_copy_options(a.compression, a.row_group_size, a.compression_level)
 
-    written = 0
-    for (rb, db) in bins:
+    if a.phase2 in ("copy", "arrow"):
+        # The surviving bins go in as literal pairs: hive pruning evaluates constant predicates
+        # before any file is opened, so other bins' footers are never read. (An IN (SELECT ...)
+        # over a bins table only narrows each column's min/max at run time.)
+        bin_pairs = ", ".join(f"({int(rb)}, {int(db)})" for rb, db in survivor_bins
+                              if rb is not None and db is not None)
+        survivors_sql = f"""
+              SELECT {out_select}
+              FROM optical_wide o
+              SEMI JOIN survivors_keys s
+                ON s.tile_id = o.tile_id AND s.NUMBER = o.NUMBER
+               AND s.ra_bin = o.ra_bin AND s.dec_bin = o.dec_bin
+              WHERE (o.ra_bin, o.dec_bin) IN ({bin_pairs or "(NULL, NULL)"})"""
+        if a.phase2 == "copy":
+            # One scan of the master; DuckDB fans the rows out to ra_bin=/dec_bin= directories and
+            # opens a partition's writer only when its first row arrives, so no empty bins appear.
+            # A small flush threshold keeps the per-thread partition buffers bounded under the
+            # memory limit (the v2.2 OOM came from buffering every bin before the first flush).
+            # (PER_THREAD_OUTPUT cannot be combined with PARTITION_BY; partitions are already
+            # written by all threads)
+            con.execute(f"SET partitioned_write_flush_threshold={int(a.partition_flush_rows)};")
+            con.execute(f"""
+                COPY ({survivors_sql}
+                )
+                TO {sql_quote(out_ds.as_posix())}
+                ({parquet_opts}, PARTITION_BY (ra_bin, dec_bin), WRITE_PARTITION_COLUMNS true,
+                 FILENAME_PATTERN 'part-{{i}}', OVERWRITE_OR_IGNORE true);
+            """)
+        else:
+            # Pull the semi-join as a stream of record batches and let Arrow do the hive
+            # partitioning: memory is bounded by the batch size and Arrow's open-file buffers,
+            # not by DuckDB's partition buffers. Arrow drops ra_bin/dec_bin from the file
+            # bodies (they live in the directory names only).
+            import pyarrow.dataset as pads
+            res = con.execute(survivors_sql + ";")
+            reader = (getattr(res, "to_arrow_reader", None) or res.fetch_record_batch)(200_000)
+            pads.write_dataset(
+                reader, out_ds, format="parquet",
+                partitioning=["ra_bin", "dec_bin"], partitioning_flavor="hive",
+                basename_template="part-{i}.parquet", existing_data_behavior="delete_matching",
+                file_options=pads.ParquetFileFormat().make_write_options(
+                    compression=a.compression,
+                    compression_level=a.compression_level if a.compression == "zstd" else None),
+                max_rows_per_group=int(a.row_group_size), use_threads=True)
+        print(f"[OK] Wrote partitioned dataset under: {out_ds} (bins written: {len(survivor_bins)})")
+        con.close()
+        return
+
+    # --phase2 bins: one COPY per (ra_bin, dec_bin), for hosts where even the flushed
+    # partitioned write does not fit. Per-bin key ranges become plain predicates on the raw
+    # master columns, so the Parquet reader can skip row groups by min/max statistics
+    # (tile_id only if it is stored as text already)
+    bins = con.execute("""
+        SELECT ra_bin, dec_bin, min(NUMBER), max(NUMBER), min(tile_id), max(tile_id)
+        FROM survivors_keys GROUP BY ra_bin, dec_bin ORDER BY ra_bin, dec_bin;
+    """).fetchall()
+    tile_id_is_text = opt_types["tile_id"] == "VARCHAR"
+
+    # Few survivors: the bin scans are dominated by opening every tile's part file. The master
+    # is written one part-<tile_id>.parquet per tile and bin (merge_tile_catalogs), so read just
+    # the files of tiles that still have survivors; any bin not in that layout uses the glob.
+    bin_tiles = {}
+    if survivors_arrow.num_rows <= a.small_survivors:
+        bin_tiles = {(rb, db): tiles for rb, db, tiles in con.execute(
+            "SELECT ra_bin, dec_bin, list(DISTINCT tile_id) FROM survivors_keys GROUP BY ra_bin, dec_bin;"
+        ).fetchall()}
+        print(f"[INFO] {survivors_arrow.num_rows} survivor keys; phase 2 reads only surviving tiles' files")
+
+    copy_sql = """
+            COPY (
+              SELECT """ + out_select + """
+              FROM {source} o
+              SEMI JOIN (
+                SELECT tile_id, NUMBER FROM survivors_keys
+                WHERE ra_bin = {rb} AND dec_bin = {db}
+              ) s ON s.tile_id = o.tile_id AND s.NUMBER = o.NUMBER
+              WHERE o.ra_bin = {rb} AND o.dec_bin = {db}
+              AND o.NUMBER BETWEEN {num_lo} AND {num_hi}{tile_range}
+            )
+            TO {path}
+            (""" + parquet_opts + ");"
+    tile_range = " AND o.tile_id BETWEEN {tile_lo} AND {tile_hi}" if tile_id_is_text else ""
+    # The glob-backed COPY is planned once and executed per bin (hive/row-group pruning still
+    # applies to bound parameters); only per-tile file lists need their own statement.
+    params = ("path", "rb", "db", "num_lo", "num_hi") + (("tile_lo", "tile_hi") if tile_id_is_text else ())
+    placeholders = {k: f"${i}" for i, k in enumerate(params, start=1)}
+    prepare_sql = "PREPARE copy_bin AS " + copy_sql.format(
+        source="optical_wide", tile_range=tile_range.format(**placeholders), **placeholders)
+    con.execute(prepare_sql)
+
+    # plain string paths per bin (bins are distinct, so one makedirs each); the per-tile
+    # files are checked against the master listing instead of one stat per file
+    out_base = out_ds.as_posix()
+    opt_file_set = set(opt_files)
+
+    def write_bin(cur, rb, db, num_lo, num_hi, tile_lo, tile_hi):
         rbv = int(rb) if rb is not None else None
         dbv = int(db) if db is not None else None
-        subdir = out_ds / f"ra_bin={rbv}" / f"dec_bin={dbv}"
-        subdir.mkdir(parents=True, exist_ok=True)
-        out_file = subdir / f"part-{rbv}-{dbv}.parquet"
+        subdir = f"{out_base}/ra_bin={rbv}/dec_bin={dbv}"
+        os.makedirs(subdir, exist_ok=True)
+        values = dict(path=sql_quote(f"{subdir}/part-{rbv}-{dbv}.parquet"), rb=rbv, db=dbv,
+                      num_lo=num_lo if num_lo is not None else "NULL",
+                      num_hi=num_hi if num_hi is not None else "NULL",
+                      tile_lo=sql_quote(tile_lo), tile_hi=sql_quote(tile_hi))
+        source = "optical_wide"
+        if (rb, db) in bin_tiles:
+            parts = [os.path.join(opt_root, f"ra_bin={rbv}", f"dec_bin={dbv}", f"part-{t}.parquet")
+                     for t in bin_tiles[(rb, db)]]
+            if opt_file_set.issuperset(parts):
+                source = (f"read_parquet([{', '.join(sql_quote(p) for p in parts)}],"
+                          f" hive_partitioning=1)")
 
         # write one bin
-        con.execute(f"""
-            COPY (
-              SELECT o.*
-              FROM optical_wide o
-              WHERE o.ra_bin = {rbv} AND o.dec_bin = {dbv}
-              AND EXISTS (
-                SELECT 1
-                FROM survivors_keys s
-                WHERE s.ra_bin = {rbv} AND s.dec_bin = {dbv}
-                  AND s.tile_id = o.tile_id AND s.NUMBER = o.NUMBER
-              )
-            )
-            TO {sql_quote(out_file.as_posix())}
-            (FORMAT PARQUET);
-        """)
-        written += 1
-        if written % 50 == 0:
-            print(f"[INFO] Wrote {written}/{len(bins)} bins...")
+        if source == "optical_wide":
+            cur.execute(f"EXECUTE copy_bin({', '.join(str(values[k]) for k in params)});")
+        else:
+            cur.execute(copy_sql.format(source=source, tile_range=tile_range.format(**values), **values))
+
+    # --phase2-workers N > 1: bins are written concurrently (DuckDB releases the GIL while a COPY
+    # runs, and every bin has its own output file). TEMP views, registered tables and prepared
+    # statements are per connection, so each worker thread sets up its own cursor like con.
+    workers = max(1, int(a.phase2_workers))
+    local, cursors = threading.local(), []
+
+    def worker_bin(row):
+        if not hasattr(local, "cur"):
+            cur = con.cursor()
+            cur.register("survivors_keys", survivors_arrow)
+            cur.execute(optical_wide_sql)
+            cur.execute(prepare_sql)
+            local.cur = cur
+            cursors.append(cur)
+        write_bin(local.cur, *row)
+
+    written = 0
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        done = (write_bin(con, *row) for row in bins) if workers == 1 else \
+               (f.result() for f in as_completed([ex.submit(worker_bin, row) for row in bins]))
+        for _ in done:
+            written += 1
+            if written % 50 == 0:
+                print(f"[INFO] Wrote {written}/{len(bins)} bins...")
+    for cur in cursors:
+        cur.close()
 
     print(f"[OK] Wrote partitioned dataset under: {out_ds} (bins written: {written})")
     con.close()
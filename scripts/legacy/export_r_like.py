@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 """
-export_r_like.py — v3.0 (remainder-capable; no DuckDB required)
+export_r_like.py — v3.1 (remainder-capable; no DuckDB required)
 
 - Reads masked union (file or directory of parquet parts)
 - Normalizes tile_id from row_id (always)
@@ -9,6 +9,8 @@ export_r_like.py — v3.0 (remainder-capable; no DuckDB required)
 - Optional: apply "remainder" predicate (SkyBoT-aware) to produce the ~150 rows
 - Optional: core-only filter using tile_plate_edge_report.csv
 - Writes Parquet + optional CSV + metrics JSON sidecar
+- v3.1: streams the union batch by batch into one ParquetWriter (and CSVWriter), so memory
+  stays bounded to a batch instead of the whole union
 
 Examples:
   # Inclusive remainder (the 150 list)
@@ -30,60 +32,119 @@ Examples:
 
 from __future__ import annotations
 import argparse, json
+from functools import reduce
 from pathlib import Path
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 # Coordinate preference ladder (per-row coords first)
 COMMON_RA  = ['RA_row','ra_row','RA','ra','ALPHAWIN_J2000','ALPHA_J2000']
 COMMON_DEC = ['Dec_row','dec_row','Dec','DEC','dec','DELTAWIN_J2000','DELTA_J2000']
 
-def pick_col(df, candidates):
+SCAN_BATCH_ROWS = 65_536
+CSV_BUFFER = 4 * 1024 * 1024
+
+# Output columns (keep only what's needed + gates); RA/Dec are the normalized coords
+OUT_COLS = [
+    "row_id","NUMBER","tile_id","plate_id","date_obs_iso",
+    "has_vosa_like_match","is_supercosmos_artifact","ptf_match_ngood",
+    "is_known_variable_or_transient","skybot_strict","skybot_wide",
+    "RA","Dec"
+]
+
+def pick_col(cols, candidates):
     for c in candidates:
-        if c in df.columns:
+        if c in cols:
             return c
     return None
 
-def extract_tile_id(row_id: str) -> str:
-    return str(row_id).split(':', 1)[0]
-
-def normalize_coords(df: pd.DataFrame) -> pd.DataFrame:
-    ra = pick_col(df, COMMON_RA)
-    dec = pick_col(df, COMMON_DEC)
+def coord_cols(cols) -> tuple[str, str]:
+    ra = pick_col(cols, COMMON_RA)
+    dec = pick_col(cols, COMMON_DEC)
     if ra is None or dec is None:
-        raise RuntimeError(f"No usable coord columns found. Have: {list(df.columns)[:50]} ...")
-    out = df.copy()
-    if ra != 'RA':
-        out = out.rename(columns={ra: 'RA'})
-    if dec != 'Dec':
-        out = out.rename(columns={dec: 'Dec'})
-    return out
-
-def apply_remainder_predicate(df: pd.DataFrame) -> pd.DataFrame:
-    # SkyBoT-aware remainder predicate (match your canonical logic)
-    # keep rows where all gates are false/zero
-    def col(name, default):
-        return df[name] if name in df.columns else default
-
-    hv = col("has_vosa_like_match", False)
-    hs = col("is_supercosmos_artifact", False)
-    ptf = col("ptf_match_ngood", 0)
-    vx = col("is_known_variable_or_transient", False)
-    sb = col("skybot_strict", False)
-
-    # ptf may be bool or int; normalize to int-ish
-    ptf0 = pd.to_numeric(ptf, errors="coerce").fillna(0).astype(int) if not isinstance(ptf, bool) else ptf.astype(int)
-
-    mask = (~hv.astype(bool)) & (~hs.astype(bool)) & (ptf0 == 0) & (~vx.astype(bool)) & (~sb.astype(bool))
-    return df.loc[mask].copy()
-
-def apply_core_only(df: pd.DataFrame, edge_csv: Path) -> pd.DataFrame:
+        raise RuntimeError(f"No usable coord columns found. Have: {list(cols)[:50]} ...")
+    return ra, dec
+
+def normalize_coords(tbl: pa.Table) -> pa.Table:
+    # rename in place of a copy: Arrow only relabels the schema (rename drops the metadata)
+    ra, dec = coord_cols(tbl.column_names)
+    return (tbl.rename_columns([{ra: 'RA', dec: 'Dec'}.get(c, c) for c in tbl.column_names])
+               .replace_schema_metadata(tbl.schema.metadata))
+
+def scan_masked(src: Path) -> ds.Scanner:
+    """
+    Scanner over the masked union (one file, or every *.parquet under a directory), projected to
+    the columns the export uses: OUT_COLS, the remainder gates and the chosen coordinate pair.
+    Files are unified by column name like pd.concat (missing -> null).
+    """
+    if src.is_dir():
+        files = sorted(src.rglob("*.parquet"))
+        if not files:
+            raise FileNotFoundError(f"No parquet under {src}")
+    else:
+        files = [src]
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files], promote_options="permissive")
+    if "row_id" not in schema.names:
+        raise RuntimeError("Input missing row_id — cannot export safely.")
+    ra, dec = coord_cols(schema.names)
+    # tile_id is re-derived from row_id, RA/Dec come from the chosen pair only
+    wanted = set(OUT_COLS + REMAINDER_BOOL_GATES + [REMAINDER_PTF_GATE]) - {"tile_id", "RA", "Dec"}
+    cols = [c for c in schema.names if c in wanted] + [ra, dec]
+    dataset = ds.dataset([str(f) for f in files], schema=schema, format="parquet")
+    return dataset.scanner(columns=cols, batch_size=SCAN_BATCH_ROWS)
+
+def prepare(tbl: pa.Table) -> pa.Table:
+    # Normalize coords to RA/Dec with safe preference
+    tbl = normalize_coords(tbl)
+    # Always enforce tile_id derived from row_id (text before the first ':', one Arrow kernel pass)
+    row_id = pc.cast(tbl["row_id"], pa.string())
+    return tbl.append_column("tile_id", pc.list_element(pc.split_pattern(row_id, ":", max_splits=1), 0))
+
+# Remainder gates: a row is excluded if any boolean gate is set or PTF has good matches
+REMAINDER_BOOL_GATES = ["has_vosa_like_match", "is_supercosmos_artifact",
+                        "is_known_variable_or_transient", "skybot_strict"]
+REMAINDER_PTF_GATE = "ptf_match_ngood"
+
+def remainder_keep(tbl: pa.Table):
+    """
+    Keep-mask for the remainder predicate, evaluated with pyarrow.compute.
+    Missing gate columns count as false/zero; null gates do not exclude.
+    Returns None when no gate column is present (keep everything).
+    """
+    excl = [pc.fill_null(pc.cast(tbl[c], pa.bool_()), False)
+            for c in REMAINDER_BOOL_GATES if c in tbl.column_names]
+    if REMAINDER_PTF_GATE in tbl.column_names:
+        # ptf may be bool or int; normalize to int-ish (truncate, null -> 0)
+        ptf = pc.trunc(pc.cast(tbl[REMAINDER_PTF_GATE], pa.float64()))
+        excl.append(pc.fill_null(pc.not_equal(ptf, 0.0), False))
+    if not excl:
+        return None
+    return pc.invert(reduce(pc.or_, excl))
+
+def key_codes(tile_codes, number) -> pa.Array:
+    # one int64 per (tile, NUMBER): tile code in the high 32 bits, NUMBER in the low 32 bits
+    return pc.bit_wise_or(pc.shift_left(pc.cast(tile_codes, pa.int64()), 32),
+                          pc.bit_wise_and(pc.cast(number, pa.int64()), 0xFFFFFFFF))
+
+def load_core_keys(edge_csv: Path) -> tuple[pa.Array, pa.Array]:
+    """
+    (tile_id, number) keys the edge report classes as core (px or arcsec), integer-encoded:
+    returns the core tile ids (their positions are the tile codes) and the int64 keys.
+    """
     if not edge_csv.exists():
         raise FileNotFoundError(f"Edge report CSV missing: {edge_csv}")
-    er = pd.read_csv(edge_csv)
-    low = {c.lower(): c for c in er.columns}
+    # header first (names are matched case-insensitively), then parse only the needed columns
+    header = list(pd.read_csv(edge_csv, nrows=0).columns)
+    low = {c.lower(): c for c in header}
     need = {"tile_id","number","class_px","class_arcsec"}
     if not need.issubset(set(low.keys())):
-        raise RuntimeError(f"Edge report missing columns {need - set(low.keys())}; has {list(er.columns)}")
+        raise RuntimeError(f"Edge report missing columns {need - set(low.keys())}; has {header}")
+    er = pacsv.read_csv(edge_csv, convert_options=pacsv.ConvertOptions(
+        include_columns=[low[c] for c in sorted(need)])).to_pandas()
 
     er = er.rename(columns={
         low["tile_id"]: "tile_id",
@@ -93,14 +154,19 @@ def apply_core_only(df: pd.DataFrame, edge_csv: Path) -> pd.DataFrame:
     })
     er["is_core"] = (er["class_px"].astype(str).str.lower().eq("core") |
                     er["class_arcsec"].astype(str).str.lower().eq("core"))
-
-    # Join on (tile_id, NUMBER)
-    if "NUMBER" not in df.columns:
-        raise RuntimeError("Input missing NUMBER column; cannot apply core-only join.")
-    j = df.merge(er[["tile_id","number","is_core"]], left_on=["tile_id","NUMBER"], right_on=["tile_id","number"], how="inner")
-    j = j.loc[j["is_core"]].copy()
-    j = j.drop(columns=["number","is_core"], errors="ignore")
-    return j
+    core = er.loc[er["is_core"] & er["number"].notna(), ["tile_id","number"]]
+    core_tile = pa.array(core["tile_id"].astype(str), pa.string())
+    tiles = pc.unique(core_tile)
+    return tiles, key_codes(pc.index_in(core_tile, value_set=tiles), pa.array(core["number"]))
+
+def core_keep(tbl: pa.Table, core_keys: tuple[pa.Array, pa.Array]):
+    # Semi-join on (tile_id, NUMBER) as an int64 key-membership mask: the string tile_id is
+    # encoded once against the core tiles (index_in; null for tiles without core rows), so the
+    # per-row hashing is on fixed-width keys, the survivors are not widened and a key repeated
+    # in the report keeps its row once
+    tiles, keys = core_keys
+    codes = pc.index_in(tbl["tile_id"], value_set=tiles)
+    return pc.fill_null(pc.is_in(key_codes(codes, tbl["NUMBER"]), value_set=keys), False)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -118,52 +184,57 @@ def main():
     core_only = (args.core_only.lower() == "true")
 
     src = Path(args.masked)
-    if src.is_dir():
-        files = sorted(src.rglob("*.parquet"))
-        if not files:
-            raise FileNotFoundError(f"No parquet under {src}")
-        df = pd.concat([pd.read_parquet(f) for f in files], ignore_index=True)
-    else:
-        df = pd.read_parquet(src)
-
-    if "row_id" not in df.columns:
-        raise RuntimeError("Input missing row_id — cannot export safely.")
-
-    # Always enforce tile_id derived from row_id
-    df["tile_id"] = df["row_id"].astype(str).apply(extract_tile_id)
-
-    # Normalize coords to RA/Dec with safe preference
-    df = normalize_coords(df)
-
-    # Apply remainder filter if requested
-    if remainder_only:
-        df = apply_remainder_predicate(df)
-
-    # Apply core-only filter if requested
-    if core_only:
-        df = apply_core_only(df, Path(args.edge_report))
+    scanner = scan_masked(src)
+    # the output schema follows from the projection; an empty table goes through the same steps
+    empty = prepare(scanner.projected_schema.empty_table())
+    if core_only and "NUMBER" not in empty.column_names:
+        raise RuntimeError("Input missing NUMBER column; cannot apply core-only join.")
+    core_keys = load_core_keys(Path(args.edge_report)) if core_only else None
 
     # Select output columns (keep only what’s needed + gates)
-    keep = [
-        "row_id","NUMBER","tile_id","plate_id","date_obs_iso",
-        "has_vosa_like_match","is_supercosmos_artifact","ptf_match_ngood",
-        "is_known_variable_or_transient","skybot_strict","skybot_wide",
-        "RA","Dec"
-    ]
-    keep_cols = [c for c in keep if c in df.columns]
-    out_df = df[keep_cols].copy()
+    keep_cols = [c for c in OUT_COLS if c in empty.column_names]
+    out_schema = empty.select(keep_cols).schema
 
     out_parq = Path(args.out)
     out_parq.parent.mkdir(parents=True, exist_ok=True)
-    out_df.to_parquet(out_parq, index=False)
-
     csv_path = ""
     if emit_csv:
         csv_path = args.csv_out if args.csv_out else str(out_parq.with_suffix(".csv"))
-        out_df.to_csv(csv_path, index=False)
+
+    # Stream: filter each batch on the Arrow side and append it to one ParquetWriter (and one
+    # Arrow CSVWriter: strings quoted, booleans as true/false, behind a 4 MB buffered stream)
+    rows = 0
+    writer = pq.ParquetWriter(out_parq, out_schema, compression="zstd", use_dictionary=True)
+    sink = pa.output_stream(csv_path, buffer_size=CSV_BUFFER) if emit_csv else None
+    wcsv = pacsv.CSVWriter(sink, out_schema) if emit_csv else None
+    try:
+        for batch in scanner.to_batches():
+            if batch.num_rows == 0:
+                continue
+            tbl = prepare(pa.Table.from_batches([batch]))
+            # Apply remainder filter if requested
+            if remainder_only:
+                keep = remainder_keep(tbl)
+                if keep is not None:
+                    tbl = tbl.filter(keep)
+            # Apply core-only filter if requested
+            if core_only:
+                tbl = tbl.filter(core_keep(tbl, core_keys))
+            if tbl.num_rows == 0:
+                continue
+            out = tbl.select(keep_cols)
+            writer.write_table(out)
+            if wcsv:
+                wcsv.write_table(out)
+            rows += out.num_rows
+    finally:
+        writer.close()
+        if wcsv:
+            wcsv.close()
+            sink.close()
 
     metrics = {
-        "rows": int(len(out_df)),
+        "rows": rows,
         "source_masked": str(src.resolve()),
         "parquet": str(out_parq.resolve()),
         "csv": csv_path,
@@ -176,7 +247,7 @@ def main():
     print("[OK] wrote:", out_parq)
     if emit_csv:
         print("[OK] wrote:", csv_path)
-    print("[OK] rows:", len(out_df))
+    print("[OK] rows:", rows)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
 from __future__ import annotations
-import argparse, csv
+import argparse
+from functools import reduce
 from pathlib import Path
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 
 PRED_COLS = [
     "row_id","NUMBER","tile_id","plate_id","date_obs_iso",
@@ -20,16 +26,34 @@ def pick_pair(cols: set[str]):
             return ra, dec
     return None, None
 
-def truthy(v):
-    if v is None: return False
-    try:
-        # pandas/pyarrow may give numpy bool, int, etc.
-        if isinstance(v, bool): return v
-        if isinstance(v, (int, float)): return v != 0
-        s = str(v).strip().lower()
-        return s in ("true","1","t","yes","y")
-    except Exception:
-        return False
+CSV_BUFFER = 4 * 1024 * 1024
+TRUTHY_STR = ("true","1","t","yes","y")
+REMAINDER_GATES = ["has_vosa_like_match", "is_supercosmos_artifact", "ptf_match_ngood",
+                   "is_known_variable_or_transient", "skybot_strict"]
+
+def gate_keep(name: str, typ: pa.DataType) -> ds.Expression:
+    """
+    Dataset filter that passes a row unless the gate is truthy: bool -> as is, numeric -> != 0,
+    text -> one of TRUTHY_STR (case/space-insensitive); nulls (and NaN) never exclude.
+    Plain comparisons keep the bool/int gates prunable by row-group statistics.
+    """
+    f = ds.field(name)
+    if pa.types.is_boolean(typ):
+        return f.is_null() | (f == False)  # Arrow expression: == False, not `not f`
+    if pa.types.is_integer(typ) or pa.types.is_floating(typ):
+        return f.is_null(nan_is_null=True) | (f == 0)
+    text = pc.utf8_lower(pc.utf8_trim_whitespace(f.cast(pa.string())))
+    return ~pc.is_in(text, value_set=pa.array(TRUTHY_STR))
+
+def keep_filter(schema: pa.Schema):
+    """
+    Remainder predicate for one file, pushed into its scan: a row passes when no gate is truthy
+    (missing gate columns pass; ptf: accept 0/False as pass). Built from that file's own schema,
+    since parts may store a gate as bool in one file and int/text in another. Row groups whose
+    statistics rule every row out are skipped without being decoded.
+    """
+    gates = [gate_keep(c, schema.field(c).type) for c in REMAINDER_GATES if c in schema.names]
+    return reduce(lambda x, y: x & y, gates) if gates else None
 
 def main():
     ap = argparse.ArgumentParser()
@@ -46,9 +70,6 @@ def main():
     if not files:
         raise SystemExit(f"[ERROR] no parquet files under {root}")
 
-    import pyarrow.parquet as pq
-    import pyarrow as pa
-
     # Determine schema & coord columns from first good file
     good0 = None
     for f in files:
@@ -73,18 +94,19 @@ def main():
     keep_cols = [c for c in PRED_COLS if c in cols0] + [ra_col, dec_col]
     # ensure unique
     keep_cols = list(dict.fromkeys(keep_cols))
+    # Standardize coordinate column names to RA/Dec in outputs
+    out_names = [{ra_col: "RA", dec_col: "Dec"}.get(c, c) for c in keep_cols]
 
     out_csv = out_prefix.with_suffix(".csv")
     out_parq = out_prefix.with_suffix(".parquet")
 
-    # Stream write
+    # Stream write: Parquet and CSV writers both created from the first batch's schema
     writer = None
-    wrote_header = False
+    wcsv = None
     n_out = 0
 
-    with out_csv.open("w", newline="") as fcsv:
-        wcsv = None
-
+    # 4 MB buffered sink: the batches reach the disk in a few large writes, flushed once on close
+    with pa.output_stream(str(out_csv), buffer_size=CSV_BUFFER) as fcsv:
         for fp in files:
             # Skip bad/empty-schema parquet files safely
             try:
@@ -94,56 +116,29 @@ def main():
             except Exception:
                 continue
 
-            # iterate batches to keep memory bounded
-            for batch in pf.iter_batches(batch_size=50000, columns=keep_cols):
-                tbl = pa.Table.from_batches([batch])
-                df = tbl.to_pandas()
-
-                # remainder predicate
-                hv = df.get("has_vosa_like_match", False)
-                hs = df.get("is_supercosmos_artifact", False)
-                ptf = df.get("ptf_match_ngood", 0)
-                vx = df.get("is_known_variable_or_transient", False)
-                sb = df.get("skybot_strict", False)
-
-                # normalize to booleans
-                mask = []
-                for i in range(len(df)):
-                    ok = True
-                    if truthy(hv.iloc[i] if hasattr(hv, "iloc") else hv): ok = False
-                    if truthy(hs.iloc[i] if hasattr(hs, "iloc") else hs): ok = False
-                    # ptf: accept 0/False as pass
-                    vptf = ptf.iloc[i] if hasattr(ptf, "iloc") else ptf
-                    if truthy(vptf): ok = False
-                    if truthy(vx.iloc[i] if hasattr(vx, "iloc") else vx): ok = False
-                    if truthy(sb.iloc[i] if hasattr(sb, "iloc") else sb): ok = False
-                    mask.append(ok)
-
-                df2 = df.loc[mask].copy()
-                if df2.empty:
+            # iterate filtered, projected batches to keep memory bounded
+            scanner = ds.dataset(fp, format="parquet").scanner(
+                columns=keep_cols, filter=keep_filter(pf.schema_arrow), batch_size=50000)
+            for batch in scanner.to_batches():
+                if batch.num_rows == 0:
                     continue
+                batch = batch.rename_columns(out_names)
 
-                # Standardize coordinate column names to RA/Dec in outputs
-                df2 = df2.rename(columns={ra_col: "RA", dec_col: "Dec"})
-
-                # CSV header once
-                if not wrote_header:
-                    wcsv = csv.writer(fcsv)
-                    wcsv.writerow(list(df2.columns))
-                    wrote_header = True
-
-                # Write CSV rows
-                for row in df2.itertuples(index=False, name=None):
-                    wcsv.writerow(row)
-
-                # Write Parquet incrementally
-                t2 = pa.Table.from_pandas(df2, preserve_index=False)
+                # Write straight from Arrow (cast: later files may store a gate with a different
+                # but compatible type); CSV via Arrow's C++ writer, header once
                 if writer is None:
-                    writer = pq.ParquetWriter(out_parq, t2.schema, compression="zstd")
-                writer.write_table(t2)
-
-                n_out += len(df2)
-
+                    writer = pq.ParquetWriter(out_parq, batch.schema, compression="zstd")
+                    # \r\n as the csv.writer output had; see CHANGELOG for the dialect change
+                    wcsv = pacsv.CSVWriter(fcsv, writer.schema,
+                                           write_options=pacsv.WriteOptions(eol="\r\n"))
+                batch = batch.cast(writer.schema)
+                writer.write_batch(batch)
+                wcsv.write_batch(batch)
+
+                n_out += batch.num_rows
+
+        if wcsv:
+            wcsv.close()
     if writer:
         writer.close()
 
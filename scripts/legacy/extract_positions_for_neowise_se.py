@@ -10,17 +10,29 @@ Delta-safety (2026-02-07):
 
 Existing behaviour:
 - Detects changed Parquet parts based on {size, mtime_ns} against a JSON manifest.
+  A --manifest ending in .db/.sqlite/.sqlite3 uses a SQLite file instead: runs
+  only upsert the changed parts rather than rewriting the whole manifest.
 - Only NEW/CHANGED parts are exported to out_dir/<write_subdir>/positions_chunk_*.csv.
 - Optional: fan out NEOWISE-SE per-chunk runs (--run-neowise).
 - row_id is always materialized as a string of digits (durable).
 """
 import argparse
 import json
+import sqlite3
 import sys
 import hashlib
 from pathlib import Path
-from typing import List, Dict, Optional, Tuple
+from typing import List, Dict, Iterable, Optional, Tuple
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# ---- Make scripts/ importable without requiring it to be a Python package ----
+SCRIPTS_DIR = Path(__file__).resolve().parents[1]
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+from utils_fs import atomic_write_text, fsync_path
 
 DEFAULT_MANIFEST = "./data/local-cats/tmp/positions_manifest.json"
 
@@ -31,7 +43,29 @@ def file_sig(p: Path) -> Dict:
     st = p.stat()
     return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
 
+SQLITE_SUFFIXES = (".db", ".sqlite", ".sqlite3")
+
+def _is_sqlite_manifest(path: Path) -> bool:
+    return path.suffix.lower() in SQLITE_SUFFIXES
+
+def _open_sqlite_manifest(path: Path) -> sqlite3.Connection:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    con = sqlite3.connect(str(path))
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("CREATE TABLE IF NOT EXISTS manifest("
+                "path TEXT PRIMARY KEY, size INTEGER NOT NULL, mtime_ns INTEGER NOT NULL)")
+    return con
+
 def load_manifest(path: Path) -> Dict[str, Dict]:
+    if _is_sqlite_manifest(path):
+        if not path.exists():
+            return {}
+        con = _open_sqlite_manifest(path)
+        try:
+            return {k: {"size": sz, "mtime_ns": mt}
+                    for k, sz, mt in con.execute("SELECT path, size, mtime_ns FROM manifest")}
+        finally:
+            con.close()
     if path.exists():
         try:
             return json.loads(path.read_text())
@@ -39,25 +73,46 @@ def load_manifest(path: Path) -> Dict[str, Dict]:
             return {}
     return {}
 
-def save_manifest(path: Path, data: Dict[str, Dict]):
+def save_manifest(path: Path, data: Dict[str, Dict], delta: Optional[Dict[str, Dict]] = None):
+    """JSON: rewrite `data` atomically. SQLite: upsert only `delta` (all of `data` if None)."""
+    if _is_sqlite_manifest(path):
+        rows = delta if delta is not None else data
+        con = _open_sqlite_manifest(path)
+        try:
+            with con:  # one transaction
+                con.executemany(
+                    "INSERT INTO manifest(path, size, mtime_ns) VALUES (?, ?, ?) "
+                    "ON CONFLICT(path) DO UPDATE SET size=excluded.size, mtime_ns=excluded.mtime_ns",
+                    ((k, v["size"], v["mtime_ns"]) for k, v in rows.items()),
+                )
+        finally:
+            con.close()
+        return
     path.parent.mkdir(parents=True, exist_ok=True)
-    tmp = path.with_suffix(".tmp")
-    tmp.write_text(json.dumps(data, indent=2))
-    tmp.replace(path)
+    atomic_write_text(path, json.dumps(data, indent=2))
 
-def autodetect_columns(df: pd.DataFrame) -> Tuple[Optional[str], Optional[str], bool, Optional[str]]:
+def autodetect_columns(names: Iterable[str]) -> Tuple[Optional[str], Optional[str], bool, Optional[str]]:
+    names = set(names)
     ra_cands = ["ALPHAWIN_J2000","ALPHA_J2000","X_WORLD","alpha","ra"]
     de_cands = ["DELTAWIN_J2000","DELTA_J2000","Y_WORLD","delta","dec"]
-    ra_col = next((c for c in ra_cands if c in df.columns), None)
-    de_col = next((c for c in de_cands if c in df.columns), None)
-    has_row_id = "row_id" in df.columns
-    tile_col = next((c for c in ("tile_id","tile","tile_name") if c in df.columns), None)
+    ra_col = next((c for c in ra_cands if c in names), None)
+    de_col = next((c for c in de_cands if c in names), None)
+    has_row_id = "row_id" in names
+    tile_col = next((c for c in ("tile_id","tile","tile_name") if c in names), None)
     return ra_col, de_col, has_row_id, tile_col
 
 def stable_row_id(tile_id: str, local_index: int) -> int:
     h = hashlib.sha1(f"{tile_id}:{local_index}".encode("utf-8")).digest()
     return int.from_bytes(h[:8], byteorder="big", signed=False)
 
+def stable_row_ids(tile_ids: Iterable[str], local_indices: Iterable[int]) -> List[str]:
+    """Bulk stable_row_id() as digit strings (same SHA-1 digests), without per-row pandas indexing."""
+    sha1, from_bytes = hashlib.sha1, int.from_bytes
+    return [
+        str(from_bytes(sha1(f"{t}:{i}".encode("utf-8")).digest()[:8], byteorder="big", signed=False))
+        for t, i in zip(tile_ids, local_indices)
+    ]
+
 def _to_row_id_str_series(s: pd.Series) -> pd.Series:
     def conv(x):
         if pd.isna(x):
@@ -71,11 +126,13 @@ def _to_row_id_str_series(s: pd.Series) -> pd.Series:
             return str(x)
     return s.apply(conv).astype("string")
 
-def load_positions_from_part(part_path: Path) -> pd.DataFrame:
-    df = pd.read_parquet(part_path)
-    ra_col, de_col, has_row_id, tile_col = autodetect_columns(df)
+def load_positions_from_part(part_path: Path) -> pa.Table:
+    """Read only the coordinate/key columns of one part and return (row_id, ra, dec) as Arrow."""
+    ra_col, de_col, has_row_id, tile_col = autodetect_columns(pq.read_schema(part_path).names)
     if ra_col is None or de_col is None:
         raise RuntimeError(f"Could not find RA/Dec columns in {part_path}")
+    cols = [ra_col, de_col] + (["row_id"] if has_row_id else ([tile_col] if tile_col else []))
+    df = pq.read_table(part_path, columns=cols).to_pandas()
     out = pd.DataFrame({
         "ra":  pd.to_numeric(df[ra_col], errors="coerce").astype("float64"),
         "dec": pd.to_numeric(df[de_col], errors="coerce").astype("float64"),
@@ -86,15 +143,11 @@ def load_positions_from_part(part_path: Path) -> pd.DataFrame:
         local_idx = pd.RangeIndex(start=0, stop=len(out), step=1)
         if tile_col is not None:
             tiles = df[tile_col].astype(str).fillna("unknown")
-            if tiles.nunique() == 1:
-                tconst = tiles.iloc[0]
-                out["row_id"] = pd.Series([str(stable_row_id(tconst, i)) for i in local_idx], dtype="string")
-            else:
-                out["row_id"] = pd.Series([str(stable_row_id(tiles.iloc[i], i)) for i in local_idx], dtype="string")
+            out["row_id"] = pd.Series(stable_row_ids(tiles.to_numpy(), local_idx), dtype="string")
         else:
             out["row_id"] = pd.Series([str(i) for i in local_idx], dtype="string")
     out = out.dropna(subset=["ra","dec"]).reset_index(drop=True)
-    return out[["row_id","ra","dec"]]
+    return pa.Table.from_pandas(out[["row_id","ra","dec"]], preserve_index=False)
 
 def write_chunks(df_all: pd.DataFrame, out_dir: Path, chunk_size: int, subdir: str) -> List[Path]:
     target = out_dir / subdir
@@ -102,10 +155,9 @@ def write_chunks(df_all: pd.DataFrame, out_dir: Path, chunk_size: int, subdir: s
     chunks: List[Path] = []
     counter = 1
     for start in range(0, len(df_all), chunk_size):
-        chunk = df_all.iloc[start: start + chunk_size].copy()
         fname = target / f"positions_chunk_{counter:05d}.csv"
-        chunk["row_id"] = chunk["row_id"].astype("string")
-        chunk[["row_id","ra","dec"]].to_csv(fname, index=False)
+        # row_id is already "string" (asserted in main); write the slice as-is.
+        df_all.iloc[start: start + chunk_size][["row_id","ra","dec"]].to_csv(fname, index=False)
         chunks.append(fname)
         counter += 1
     return chunks
@@ -177,8 +229,11 @@ def main():
     if not parts:
         raise SystemExit(f"No parquet files found under {root}")
 
-    # preflight: compute changed parts (stat-only; constant RAM)
+    # preflight: compute changed parts (stat-only; constant RAM). The signature
+    # taken here is what gets recorded: a part rewritten while we read it will
+    # still look changed on the next run.
     changed_parts: List[Path] = []
+    changed_sigs: Dict[str, Dict] = {}
     for p in parts:
         key = str(p.relative_to(root))
         sig = file_sig(p)
@@ -186,6 +241,7 @@ def main():
            manifest[key].get("size") != sig["size"] or \
            manifest[key].get("mtime_ns") != sig["mtime_ns"]:
             changed_parts.append(p)
+            changed_sigs[key] = sig
 
     print(f"[PREL. INFO] changed_parts={len(changed_parts)}")
     for p in changed_parts[:50]:
@@ -205,29 +261,40 @@ def main():
         print("[INFO] No changes detected; nothing to write.")
         return
 
-    # load positions for changed parts only
-    frames: List[pd.DataFrame] = []
+    # load positions for changed parts only; Arrow concat references the
+    # per-part buffers instead of copying them, and pandas is built once.
+    tables: List[pa.Table] = []
     for p in changed_parts:
         try:
-            frames.append(load_positions_from_part(p))
+            tables.append(load_positions_from_part(p))
         except Exception as e:
             print(f"[WARN] Skipping {p}: {e}", file=sys.stderr)
 
-    if not frames:
+    if not tables:
         raise SystemExit("No positions could be extracted from changed parts")
 
-    df_all = pd.concat(frames, ignore_index=True)
+    all_tbl = pa.concat_tables(tables)
+    tables.clear()
+    string_types = {pa.string(): pd.StringDtype(), pa.large_string(): pd.StringDtype()}
+    df_all = all_tbl.to_pandas(self_destruct=True, types_mapper=string_types.get)
+    del all_tbl
     if "row_id" in df_all.columns:
+        if df_all["row_id"].dtype.name != "string":
+            raise SystemExit(f"row_id must be read as text, got {df_all['row_id'].dtype}")
         df_all = df_all.drop_duplicates(subset=["row_id"]).reset_index(drop=True)
 
     chunks = write_chunks(df_all, out_dir, args.chunk_size, args.write_subdir)
     print(f"[INFO] Wrote {len(chunks)} positions chunk(s) to {out_dir / args.write_subdir}")
 
-    # Update manifest only for changed parts (delta)
-    for p in changed_parts:
-        key = str(p.relative_to(root))
-        manifest[key] = file_sig(p)
-    save_manifest(man_path, manifest)
+    # Chunks must be durable before the manifest marks their parts as done.
+    for c in chunks:
+        fsync_path(c)
+    if chunks:
+        fsync_path(chunks[0].parent)
+
+    # Update manifest only for changed parts (delta), reusing the preflight stat
+    manifest.update(changed_sigs)
+    save_manifest(man_path, manifest, changed_sigs)
 
     if args.run_neowise:
         neo_out = Path(args.neowise_out_dir)
@@ -26,10 +26,18 @@ Masks:
 """
 
 import argparse
-import os
+import glob
+import sys
 from pathlib import Path
 from typing import Tuple, List, Optional
 
+# ---- Make scripts/ importable without requiring it to be a Python package ----
+SCRIPTS_DIR = Path(__file__).resolve().parents[1]
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+from utils_duckdb_sql import packed_grid_key, parquet_copy_options, sql_quote, typed
+
 def parse_args():
     p = argparse.ArgumentParser()
     p.add_argument("--optical-master-parquet", required=True)
@@ -43,11 +51,10 @@ def parse_args():
     p.add_argument("--dec-col", default=None)
     p.add_argument("--duckdb-path", default=None, help="Optional on-disk duckdb file (default: <out-dir>/post16_tmp.duckdb)")
     p.add_argument("--duckdb-threads", type=int, default=4)
+    p.add_argument("--compression", choices=["snappy", "zstd", "lz4"], default="zstd")
+    p.add_argument("--row-group-size", type=int, default=1_000_000)
     return p.parse_args()
 
-def sql_quote(s: str) -> str:
-    return "'" + str(s).replace("'", "''") + "'"
-
 def pick_coords(cols: List[str], ra_override: Optional[str], dec_override: Optional[str]) -> Tuple[str, str]:
     if ra_override and dec_override and ra_override in cols and dec_override in cols:
         return ra_override, dec_override
@@ -79,12 +86,18 @@ def main():
     con.execute(f"PRAGMA threads={int(a.duckdb_threads)};")
     con.execute("PRAGMA memory_limit='2GB';")
 
-    opt_glob = os.path.join(a.optical_master_parquet, "**", "*.parquet")
+    # forward slashes on every OS: this string goes to DuckDB's glob as-is
+    opt_glob = Path(a.optical_master_parquet).as_posix().rstrip("/") + "/**/*.parquet"
     ir_path = a.irflags_parquet
 
-    # Read schemas (lightweight)
-    opt_cols = [r[0] for r in con.execute(f"DESCRIBE SELECT * FROM read_parquet({sql_quote(opt_glob)}, hive_partitioning=1) LIMIT 0;").fetchall()]
-    ir_cols  = [r[0] for r in con.execute(f"DESCRIBE SELECT * FROM read_parquet({sql_quote(ir_path)}) LIMIT 0;").fetchall()]
+    # Read schemas (lightweight): the master's from one part file, as DuckDB would take a glob's
+    # schema from its first file anyway, without listing the whole glob first
+    first_part = next(glob.iglob(opt_glob, recursive=True), None)
+    if first_part is None:
+        raise SystemExit(f"[ERROR] No parquet files under {a.optical_master_parquet}")
+    opt_types = {r[0]: r[1] for r in con.execute(f"DESCRIBE SELECT * FROM read_parquet({sql_quote(first_part)}, hive_partitioning=1) LIMIT 0;").fetchall()}
+    ir_types  = {r[0]: r[1] for r in con.execute(f"DESCRIBE SELECT * FROM read_parquet({sql_quote(ir_path)}) LIMIT 0;").fetchall()}
+    opt_cols, ir_cols = list(opt_types), list(ir_types)
 
     # Join key selection: prefer (tile_id, NUMBER)
     if not ("tile_id" in opt_cols and "NUMBER" in opt_cols):
@@ -94,6 +107,7 @@ def main():
 
     ra_col, dec_col = pick_coords(opt_cols, a.ra_col, a.dec_col)
     grid = float(a.dedupe_tol_arcsec) / 3600.0
+    ra_sql, dec_sql = typed(ra_col, opt_types, "DOUBLE"), typed(dec_col, opt_types, "DOUBLE")
 
     # Optional mask columns (default False if missing)
     mask_cols = ["is_morphology_bad", "is_spike", "is_hpm", "is_skybot", "is_supercosmos_artifact"]
@@ -107,55 +121,60 @@ def main():
     con.execute(f"""
         CREATE VIEW ir AS
         SELECT
-          tile_id::VARCHAR AS tile_id,
-          NUMBER::BIGINT AS NUMBER,
-          has_ir_match::BOOLEAN AS has_ir_match,
-          dist_arcsec::DOUBLE AS dist_arcsec
+          {typed("tile_id", ir_types, "VARCHAR")} AS tile_id,
+          {typed("NUMBER", ir_types, "BIGINT")} AS NUMBER,
+          {typed("has_ir_match", ir_types, "BOOLEAN")} AS has_ir_match,
+          {typed("dist_arcsec", ir_types, "DOUBLE")} AS dist_arcsec
         FROM read_parquet({sql_quote(ir_path)});
     """)
 
     # Dedupe + join + summary in one go.
     # Dedupe key uses rounded grid cell on RA/Dec.
     # Deterministic choice: smallest (tile_id, NUMBER) per cell.
-    # Also ensure mask columns exist (default False if missing).
-    select_masks = []
-    for c in mask_cols:
-        if c in present_masks:
-            select_masks.append(f"CAST({c} AS BOOLEAN) AS {c}")
-        else:
-            select_masks.append(f"FALSE AS {c}")
-    select_masks_sql = ",\n          ".join(select_masks)
+    # The mask columns ride through the dedupe packed into one UTINYINT (bit i = mask_cols[i];
+    # missing or NULL -> 0), so the aggregate keeps one flag state per cell instead of five.
+    bits = [f"(CASE WHEN CAST({c} AS BOOLEAN) THEN {1 << i} ELSE 0 END)"
+            for i, c in enumerate(mask_cols) if c in present_masks]
+    flag_bits_sql = f"CAST({' | '.join(bits) or '0'} AS UTINYINT) AS flag_bits"
+    unpack_masks_sql = ",\n          ".join(
+        f"(r.flag_bits & {1 << i}) <> 0 AS {c}" for i, c in enumerate(mask_cols))
+    # hash-aggregate dedupe: the kept columns come from the min-(tile_id, NUMBER) row of each cell,
+    # carried in one min(struct) whose leading fields are the ordering key
+    dedupe_picks_sql = "min(struct_pack(tile_id, NUMBER, flag_bits)) AS k"
 
     # Create deduped+joined view
     con.execute(f"""
         CREATE VIEW joined_dedup AS
         WITH base AS (
           SELECT
-            tile_id::VARCHAR AS tile_id,
-            NUMBER::BIGINT AS NUMBER,
-            {ra_col}::DOUBLE AS ra,
-            {dec_col}::DOUBLE AS dec,
-            CAST(round(({ra_col}::DOUBLE) / {grid}) AS BIGINT) AS dk_ra,
-            CAST(round(({dec_col}::DOUBLE) / {grid}) AS BIGINT) AS dk_dec,
-            {select_masks_sql}
+            {typed("tile_id", opt_types, "VARCHAR")} AS tile_id,
+            {typed("NUMBER", opt_types, "BIGINT")} AS NUMBER,
+            {ra_sql} AS ra,
+            {dec_sql} AS dec,
+            {packed_grid_key(ra_sql, dec_sql, grid)} AS dk,
+            {flag_bits_sql}
           FROM optical
+          WHERE {ra_col} IS NOT NULL AND {dec_col} IS NOT NULL
         ),
-        ranked AS (
-          SELECT *,
-            row_number() OVER (PARTITION BY dk_ra, dk_dec ORDER BY tile_id, NUMBER) AS rn
-          FROM base
-          WHERE ra IS NOT NULL AND dec IS NOT NULL
+        deduped AS (
+          SELECT dk, k.tile_id, k.NUMBER, k.flag_bits
+          FROM (
+            SELECT
+              dk,
+              {dedupe_picks_sql}
+            FROM base
+            GROUP BY dk
+          )
         )
         SELECT
           r.tile_id, r.NUMBER,
-          r.dk_ra, r.dk_dec,
+          r.dk,
           COALESCE(i.has_ir_match, FALSE) AS has_ir_match,
           i.dist_arcsec AS dist_arcsec,
-          r.is_morphology_bad, r.is_spike, r.is_hpm, r.is_skybot, r.is_supercosmos_artifact
-        FROM ranked r
+          {unpack_masks_sql}
+        FROM deduped r
         LEFT JOIN ir i
-          ON r.tile_id = i.tile_id AND r.NUMBER = i.NUMBER
-        WHERE r.rn = 1;
+          ON r.tile_id = i.tile_id AND r.NUMBER = i.NUMBER;
     """)
 
     # Summary
@@ -202,6 +221,7 @@ def main():
 
     print(f"[OK] Summary written: {summary_path}")
 
+    parquet_opts = parquet_copy_options(a.compression, a.row_group_size)
     # Optional annotated export
     if a.publish_annotated:
         out_parquet = out_dir / "annotated.parquet"
@@ -214,7 +234,7 @@ def main():
             FROM joined_dedup
           )
           TO {sql_quote(out_parquet.as_posix())}
-          (FORMAT PARQUET);
+          ({parquet_opts});
         """)
         print(f"[OK] Annotated dataset written: {out_parquet}")
 
@@ -4,7 +4,9 @@
 
 """
 CSV → Parquet (Hive-style partitions: ra_bin=XX/dec_bin=YY/) with ZSTD compression.
-Writes **one file per partition at a time** to avoid 'Too many open files' (errno 24).
+Each CSV chunk is written with a single pyarrow.dataset.write_dataset call; the
+number of simultaneously open files is capped (--max-open-files) to avoid
+'Too many open files' (errno 24).
 
 Usage (when amount of data grows, try bin-deg 2)
   python scripts/make_master_optical_parquet.py \
@@ -21,13 +23,16 @@ import pandas as pd
 
 try:
     import pyarrow as pa
-    import pyarrow.parquet as pq
+    import pyarrow.dataset as ds
 except Exception as e:
     raise SystemExit(f"[ERROR] pyarrow is required: {e}")
 
 CAND_RA  = ["ALPHA_J2000", "RA", "X_WORLD", "RAJ2000", "ra"]
 CAND_DEC = ["DELTA_J2000", "DEC", "Y_WORLD", "DEJ2000", "dec"]
 
+PARTITIONING = ds.partitioning(pa.schema([("ra_bin", pa.int16()), ("dec_bin", pa.int16())]), flavor="hive")
+WRITE_OPTIONS = ds.ParquetFileFormat().make_write_options(compression="zstd", use_dictionary=True)
+
 def detect_radec_columns(csv_path: Path):
     probe = pd.read_csv(csv_path, nrows=1)
     ra = next((c for c in CAND_RA  if c in probe.columns), None)
@@ -38,55 +43,79 @@ def detect_radec_columns(csv_path: Path):
     return ra, de, extra
 
 def add_bins(df: pd.DataFrame, ra_col: str, de_col: str, bin_deg: float):
-    df[ra_col] = df[ra_col].astype("float32")
-    df[de_col] = df[de_col].astype("float32")
-    ra = df[ra_col].to_numpy(dtype=np.float32) % 360.0
+    """Add ra_bin/dec_bin; returns (df, number of rows whose NaN coords got no bin)."""
+    # Columns are already float32 from read_csv(dtype=...); to_numpy does not copy.
+    ra = df[ra_col].to_numpy(dtype=np.float32) % np.float32(360.0)
     de = df[de_col].to_numpy(dtype=np.float32)
-    df["ra_bin"]  = np.floor(ra / np.float32(bin_deg)).astype("int16")
-    df["dec_bin"] = np.floor((de + 90.0) / np.float32(bin_deg)).astype("int16")
-    return df
-
-def write_partition_file(root: Path, ra_bin: int, dec_bin: int, df_part: pd.DataFrame, file_tag: str):
-    # Ensure directories exist
-    part_dir = root / f"ra_bin={ra_bin}" / f"dec_bin={dec_bin}"
-    part_dir.mkdir(parents=True, exist_ok=True)
-    # Use deterministic file names; one file per group per chunk/tag
-    file_path = part_dir / f"part-{file_tag}.parquet"
-    # Convert to Arrow with index dropped
-    table = pa.Table.from_pandas(df_part, preserve_index=False)
-    # Single-file write; opened and closed immediately
-    pq.write_table(table, str(file_path), compression="zstd", use_dictionary=True)
-    return file_path
+    ra_bin = np.floor(ra / np.float32(bin_deg))
+    dec_bin = np.floor((de + np.float32(90.0)) / np.float32(bin_deg))
+    invalid = np.isnan(ra_bin) | np.isnan(dec_bin)
+    n_invalid = int(invalid.sum())
+    if n_invalid:
+        # NaN coords cannot be binned: keep them as <NA> (masked Int16) rather
+        # than letting the int cast invent a bogus partition; the caller drops them.
+        ra_bin[invalid] = 0
+        dec_bin[invalid] = 0
+        df["ra_bin"]  = pd.arrays.IntegerArray(ra_bin.astype(np.int16), invalid)
+        df["dec_bin"] = pd.arrays.IntegerArray(dec_bin.astype(np.int16), invalid.copy())
+    else:
+        df["ra_bin"]  = ra_bin.astype(np.int16)
+        df["dec_bin"] = dec_bin.astype(np.int16)
+    return df, n_invalid
+
+def write_chunk_partitions(root: Path, df: pd.DataFrame, file_tag: str,
+                           max_open_files: int, max_partitions: int) -> int:
+    """Write one chunk into ra_bin/dec_bin partitions; returns the number of files written."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    files = []
+    # Deterministic file names per chunk: part-<chunk>-<i>.parquet in every partition touched.
+    ds.write_dataset(
+        data=table,
+        base_dir=str(root),
+        format="parquet",
+        partitioning=PARTITIONING,
+        basename_template=f"part-{file_tag}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+        file_options=WRITE_OPTIONS,
+        max_open_files=max_open_files,
+        max_partitions=max_partitions,
+        file_visitor=files.append,
+    )
+    return len(files)
 
 def csv_to_parquet_sequential(csv_path: Path, out_root: Path,
                               ra_col: str, de_col: str, extra_cols: list[str],
-                              bin_deg: float, chunksize: int):
+                              bin_deg: float, chunksize: int, max_open_files: int):
     out_root.mkdir(parents=True, exist_ok=True)
     usecols = [ra_col, de_col] + extra_cols
 
     reader = pd.read_csv(csv_path, usecols=usecols, chunksize=chunksize,
                          dtype={ra_col: "float32", de_col: "float32"})
     total_rows = 0
+    total_invalid = 0
     chunk_idx = 0
+    # Upper bound on distinct (ra_bin, dec_bin) pairs a chunk can touch.
+    max_partitions = (int(np.ceil(360.0 / bin_deg)) + 1) * (int(np.ceil(180.0 / bin_deg)) + 1)
 
     for df in reader:
         chunk_idx += 1
-        df = add_bins(df, ra_col, de_col, bin_deg)
-
-        # Group by (ra_bin, dec_bin) and write each group to a file, sequentially
-        # This guarantees only **one file handle** open at a time.
-        written = 0
-        for (rb, db), sub in df.groupby(["ra_bin", "dec_bin"], sort=False):
-            if sub.empty:
-                continue
-            tag = f"{chunk_idx:05d}-{rb}-{db}"
-            write_partition_file(out_root, int(rb), int(db), sub, tag)
-            written += len(sub)
+        df, n_invalid = add_bins(df, ra_col, de_col, bin_deg)
+        total_invalid += n_invalid
+        # Rows with NaN coords have no bin (masked); never write them to a partition.
+        if n_invalid:
+            df = df.dropna(subset=["ra_bin", "dec_bin"])
+        if df.empty:
+            print(f"[WRITE] chunk={chunk_idx:05d} rows={0:8d} dropped_nan_coords={n_invalid}")
+            continue
+
+        nfiles = write_chunk_partitions(out_root, df, f"{chunk_idx:05d}", max_open_files, max_partitions)
 
         total_rows += len(df)
-        print(f"[WRITE] chunk={chunk_idx:05d} rows={len(df):8d} groups={written:8d} total={total_rows:10d}")
+        print(f"[WRITE] chunk={chunk_idx:05d} rows={len(df):8d} files={nfiles:8d} total={total_rows:10d}"
+              f" dropped_nan_coords={n_invalid}")
 
-    print(f"[DONE] Wrote ~{total_rows} rows to {out_root} (bin_deg={bin_deg}°, chunksize={chunksize}).")
+    print(f"[DONE] Wrote ~{total_rows} rows to {out_root} (bin_deg={bin_deg}°, chunksize={chunksize});"
+          f" dropped {total_invalid} rows with NaN RA/Dec.")
 
 def main():
     ap = argparse.ArgumentParser(description="CSV → Parquet partitions (sequential writes).")
@@ -94,6 +123,8 @@ def main():
     ap.add_argument("--out", required=True, help="Output Parquet dataset root")
     ap.add_argument("--bin-deg", type=float, default=5.0, help="Bin size (degrees)")
     ap.add_argument("--chunksize", type=int, default=500000, help="CSV read chunk size")
+    ap.add_argument("--max-open-files", type=int, default=256,
+                    help="Cap on Parquet files held open at once while writing a chunk")
     args = ap.parse_args()
 
     csv_path = Path(args.csv)
@@ -101,7 +132,8 @@ def main():
     ra_col, de_col, extra_cols = detect_radec_columns(csv_path)
     print(f"[INFO] RA/Dec: {ra_col}/{de_col}; extras: {extra_cols or 'none'}")
 
-    csv_to_parquet_sequential(csv_path, out_root, ra_col, de_col, extra_cols, args.bin_deg, args.chunksize)
+    csv_to_parquet_sequential(csv_path, out_root, ra_col, de_col, extra_cols, args.bin_deg, args.chunksize,
+                              args.max_open_files)
 
 if __name__ == "__main__":
     main()
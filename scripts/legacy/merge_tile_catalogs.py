@@ -33,6 +33,7 @@ Examples:
 """
 
 import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
 import os
 import sys
@@ -150,56 +151,65 @@ def find_coord_columns(df: pd.DataFrame) -> Tuple[str, str]:
     return ra_col, dec_col
 
 
-def pick_best(group: pd.DataFrame, mag_col: str = "MAG_AUTO", flags_col: str = "FLAGS") -> pd.Series:
-    sort_cols, asc = [], []
-    if flags_col in group.columns:
-        sort_cols.append(flags_col); asc.append(True)
-    if mag_col in group.columns:
-        sort_cols.append(mag_col);  asc.append(True)
-    if sort_cols:
-        g2 = group.sort_values(sort_cols, ascending=asc)
-        return g2.iloc[0]
-    return group.iloc[0]
+def _best_order(df: pd.DataFrame, cell: np.ndarray,
+                mag_col: str = "MAG_AUTO", flags_col: str = "FLAGS") -> np.ndarray:
+    """Row order: by cell, then FLAGS, then MAG_AUTO ascending (NaN last), stable."""
+    keys = []
+    for c in (mag_col, flags_col):  # np.lexsort: last key is primary
+        if c in df.columns:
+            keys.append(pd.to_numeric(df[c], errors="coerce").to_numpy(dtype="float64", na_value=np.nan))
+    keys.append(cell)
+    return np.lexsort(keys)
+
+
+def _as_float(col: pd.Series, dtype) -> np.ndarray:
+    """Column as a plain numpy float array (unparseable -> NaN); no copy if it already is one."""
+    if col.dtype == dtype:
+        return col.to_numpy()
+    return pd.to_numeric(col, errors="coerce").to_numpy(dtype=dtype, na_value=np.nan)
 
 
 def _enforce_schema(df: pd.DataFrame) -> pd.DataFrame:
-    for c in _RA_ALIASES:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce").astype("float32")
-    for c in _DEC_ALIASES:
-        if c in df.columns:
-            df[c] = pd.to_numeric(df[c], errors="coerce").astype("float32")
-    if "ra_bin" in df.columns:
-        df["ra_bin"] = df["ra_bin"].astype("int16")
-    if "dec_bin" in df.columns:
-        df["dec_bin"] = df["dec_bin"].astype("int16")
-    for c in _PROV_TEXT:
-        if c in df.columns:
+    # each cast is skipped when the column already has its target dtype, so repeated calls
+    # (tile frame, then every partition written) cost nothing after the first
+    for c in _RA_ALIASES + _DEC_ALIASES:
+        if c in df.columns and df[c].dtype != np.float32:
+            df[c] = _as_float(df[c], np.float32)
+    for c in ("ra_bin", "dec_bin"):
+        if c in df.columns and df[c].dtype != np.int16:
+            df[c] = df[c].astype("int16")
+    for c in _PROV_TEXT + ["plate_id"]:
+        if c in df.columns and df[c].dtype != pd.StringDtype():
             df[c] = df[c].astype("string")
-    if "plate_id" in df.columns:
-        df["plate_id"] = df["plate_id"].astype("string")
     return df
 
 
 def dedupe_by_cells(df: pd.DataFrame, ra_col: str, dec_col: str, tol_arcsec: float) -> pd.DataFrame:
-    df[ra_col]  = pd.to_numeric(df[ra_col], errors='coerce')
-    df[dec_col] = pd.to_numeric(df[dec_col], errors='coerce')
-    df = df.dropna(subset=[ra_col, dec_col])
+    # coordinates are parsed once into float64 arrays; cells come straight from them
+    ra = _as_float(df[ra_col], np.float64)
+    dec = _as_float(df[dec_col], np.float64)
+    valid = ~(np.isnan(ra) | np.isnan(dec))
+    if not valid.all():
+        df, ra, dec = df.loc[valid], ra[valid], dec[valid]
+    df = df.assign(**{ra_col: ra, dec_col: dec})
     tol_deg = tol_arcsec / 3600.0
-    df["_ra_cell"]  = (df[ra_col]  / tol_deg).round().astype("int64")
-    df["_dec_cell"] = (df[dec_col] / tol_deg).round().astype("int64")
-    out = (df.groupby(["_ra_cell", "_dec_cell"], sort=False)
-             .apply(lambda g: pick_best(g), include_groups=False)
-             .reset_index(drop=True))
-    return out.drop(columns=["_ra_cell", "_dec_cell"], errors="ignore")
+    ra_cell = np.rint(ra / tol_deg).astype(np.int64)
+    dec_cell = np.rint(dec / tol_deg).astype(np.int64)
+    # exact packed cell key (each cell index fits in 32 bits for any sane tolerance);
+    # factorize numbers cells in first-seen order, like groupby(sort=False)
+    key = (ra_cell << 32) | (dec_cell & 0xFFFFFFFF)
+    cell, _ = pd.factorize(key)
+    order = _best_order(df, cell)
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = cell[order[1:]] != cell[order[:-1]]
+    return df.iloc[order[first]].reset_index(drop=True)
 
 
 def add_bins(df: pd.DataFrame, ra_col: str, dec_col: str, bin_deg: float) -> pd.DataFrame:
-    df[ra_col]  = pd.to_numeric(df[ra_col], errors="coerce").astype("float32")
-    df[dec_col] = pd.to_numeric(df[dec_col], errors="coerce").astype("float32")
-    ra  = df[ra_col].to_numpy(dtype=np.float32) % 360.0
-    dec = df[dec_col].to_numpy(dtype=np.float32)
-    df["ra_bin"]  = np.floor(ra / np.float32(bin_deg)).astype("int16")
+    ra = _as_float(df[ra_col], np.float32)
+    dec = _as_float(df[dec_col], np.float32)
+    df[ra_col], df[dec_col] = ra, dec
+    df["ra_bin"]  = np.floor((ra % 360.0) / np.float32(bin_deg)).astype("int16")
     df["dec_bin"] = np.floor((dec + 90.0) / np.float32(bin_deg)).astype("int16")
     return df
 
@@ -366,8 +376,7 @@ def merge_one_tile(
         for (rb, db), sub in deduped.groupby(["ra_bin", "dec_bin"], sort=False):
             if sub.empty:
                 continue
-            write_partition(pub_root, int(rb), int(db), _enforce_schema(sub.copy()),
-                            tile_path.name, overwrite=overwrite)
+            write_partition(pub_root, int(rb), int(db), sub, tile_path.name, overwrite=overwrite)
         print(f"[PUBLISH] Tile {tile_path.name}: published to master dataset")
     return count
 
@@ -388,6 +397,8 @@ def main():
                     help="CSV with columns `tile_id` and REGION under `irsa_region` (fallbacks: REGION/region)")
     ap.add_argument("--require-plate", action='store_true',
                     help="Fail tiles lacking a plate mapping (default: warn & write empty)")
+    ap.add_argument("--workers", type=int, default=1,
+                    help="Merge this many tiles in parallel processes (dedupe is per tile; default: 1)")
     args = ap.parse_args()
 
     tiles_root = Path(args.tiles_root)
@@ -413,15 +424,26 @@ def main():
     else:
         present = set()
 
-    total = 0
-    for idx, tile_path in enumerate(tile_dirs, start=1):
+    todo = []
+    for tile_path in tile_dirs:
         if args.only_new and publish_root and tile_path.name in present and not args.overwrite:
             print(f"[SKIP ONLY-NEW] Tile {tile_path.name} already in master")
             continue
-        print(f"[RUN] ({idx}/{len(tile_dirs)}) Processing {tile_path.name}")
-        rows = merge_one_tile(tile_path, args.tolerance_arcsec, args.overwrite,
-                              publish_root, args.bin_deg, plate_map, args.require_plate)
-        total += rows
+        todo.append(tile_path)
+    tile_args = (args.tolerance_arcsec, args.overwrite, publish_root, args.bin_deg, plate_map, args.require_plate)
+
+    total = 0
+    if args.workers <= 1:
+        for idx, tile_path in enumerate(todo, start=1):
+            print(f"[RUN] ({idx}/{len(todo)}) Processing {tile_path.name}")
+            total += merge_one_tile(tile_path, *tile_args)
+    else:
+        # each tile reads its own catalogs and writes its own part-<tile>.parquet files
+        with ProcessPoolExecutor(max_workers=args.workers) as ex:
+            futs = {ex.submit(merge_one_tile, tile_path, *tile_args): tile_path for tile_path in todo}
+            for idx, fut in enumerate(as_completed(futs), start=1):
+                total += fut.result()
+                print(f"[RUN] ({idx}/{len(todo)}) Finished {futs[fut].name}")
     print(f"[ALL DONE] Processed {len(tile_dirs)} tiles; total rows={total}")
 
 
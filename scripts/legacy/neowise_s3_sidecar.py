@@ -10,7 +10,7 @@ TAP-equivalent defaults:
  - gates: qual_frame>0, qi_fact>0, saa_sep>0, w1snr>=5, mjd<=59198
  - moon_masked == '00' enforced AFTER read (push down uses numeric-only gates)
 """
-import os, sys, math, glob, argparse
+import os, sys, math, argparse
 from typing import List, Optional, Tuple, Iterable
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
@@ -266,22 +266,36 @@ def match_k5(opt_part_df: pd.DataFrame, years: Iterable[str], arcsec_radius: flo
     out_df = pd.DataFrame(out_rows)
     return cast_table_to_schema(pa.Table.from_pandas(out_df, preserve_index=False), sch)
 
+def list_shards(tmp_dir: str) -> List[str]:
+    """Sorted k5=*.parquet shard paths; scandir + endswith avoids glob's per-entry fnmatch."""
+    try:
+        with os.scandir(tmp_dir) as it:
+            parts = [e.path for e in it
+                     if e.name.startswith("k5=") and e.name.endswith(".parquet") and e.is_file()]
+    except FileNotFoundError:
+        return []
+    parts.sort()
+    return parts
+
 def existing_k5_in_tmp(tmp_dir: str) -> set:
     out=set()
-    for p in glob.glob(os.path.join(tmp_dir, "k5=*.parquet")):
+    for p in list_shards(tmp_dir):
         try: out.add(int(os.path.basename(p).split("=")[1].split(".")[0]))
         except Exception: pass
     return out
 
 def finalize_shards(tmp_dir: str, out_path: str, sch: pa.Schema):
-    parts = sorted(glob.glob(os.path.join(tmp_dir,"k5=*.parquet")))
+    parts = list_shards(tmp_dir)
     if not parts: print("[INFO] No shard files; skipping finalize."); return
     w = pq.ParquetWriter(out_path, schema=sch, compression="snappy")
     try:
+        # Stream each shard batch-wise: only one batch is resident, never a whole shard.
         for p in parts:
-            t = pq.read_table(p)
-            if t.schema != sch: t = cast_table_to_schema(t, sch)
-            w.write_table(t)
+            pf = pq.ParquetFile(p)
+            same = pf.schema_arrow == sch
+            for b in pf.iter_batches(batch_size=256_000):
+                if same: w.write_batch(b)
+                else: w.write_table(cast_table_to_schema(pa.Table.from_batches([b]), sch))
     finally:
         w.close()
     print(f"[DONE] Finalized {len(parts)} shards -> {out_path}")
@@ -4,29 +4,52 @@
 Rebuild NEOWISE IR sidecar from existing *_closest.csv outputs (no TAP).
 
 - Normalizes row_id from scientific notation to digit-string using Decimal (no float).
-- Aggregates to one row per row_id: min separation.
+- Streams each CSV as Arrow record batches and aggregates to one row per row_id:
+  min separation. Memory is bounded by the number of matched row_ids, not file size.
 - Optionally left-joins against a seed list (positions chunks) to produce a full-length sidecar.
 """
 
 import argparse
-import os
+import sys
 from pathlib import Path
 from decimal import Decimal, InvalidOperation, getcontext
 
-import pandas as pd
 import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
 import pyarrow.parquet as pq
 
+# ---- Make scripts/ importable without requiring it to be a Python package ----
+SCRIPTS_DIR = Path(__file__).resolve().parents[1]
+if str(SCRIPTS_DIR) not in sys.path:
+    sys.path.insert(0, str(SCRIPTS_DIR))
+
+from utils_fs import scan_closest
+
 getcontext().prec = 50  # plenty for 64-bit ids expressed in scientific notation
 
+BATCH_BYTES = 8 << 20          # CSV block size -> record batch size
+COMPACT_ROWS = 2_000_000       # re-aggregate partial (row_id, min sep) tables past this
+
 def iter_closest_files(root: Path):
-    for base in (root, root / "new"):
-        if not base.exists():
-            continue
-        for dirpath, _, filenames in os.walk(base):
-            for fn in filenames:
-                if fn.endswith("_closest.csv"):
-                    yield Path(dirpath) / fn
+    found = []
+    scan_closest(str(root), found)
+    # root/new is covered by the walk above unless it is a symlink (not followed)
+    if (root / "new").is_symlink():
+        scan_closest(str(root / "new"), found)
+    for p in sorted(set(found)):
+        yield Path(p)
+
+def open_closest_csv(path: Path) -> pacsv.CSVStreamingReader:
+    """Streaming Arrow CSV reader with row_id kept as text and separations typed up front."""
+    return pacsv.open_csv(
+        path,
+        read_options=pacsv.ReadOptions(block_size=BATCH_BYTES),
+        convert_options=pacsv.ConvertOptions(
+            column_types={"row_id": pa.string(), "sep_arcsec": pa.float64(), "dist_arcsec": pa.float64()},
+            strings_can_be_null=True,
+        ),
+    )
 
 def canonical_row_id(s: str):
     """
@@ -50,21 +73,48 @@ def canonical_row_id(s: str):
     # Convert to plain integer string
     return format(int(d), "d")
 
-def load_seed_row_ids(seed_dir: Path):
+def canonical_row_ids(ids: pa.Array) -> pa.Array:
+    """
+    canonical_row_id() over an Arrow string array. Values that are already plain
+    digit strings are kept as-is; only the rest go through Decimal.
+    """
+    plain = pc.fill_null(pc.match_substring_regex(ids, r"^(0|[1-9][0-9]*)$"), False)
+    if pc.all(plain).as_py():
+        return ids
+    return pa.array(
+        [v if ok else canonical_row_id(v) for v, ok in zip(ids.to_pylist(), plain.to_pylist())],
+        type=pa.string(),
+    )
+
+def min_sep_per_row_id(tbl: pa.Table) -> pa.Table:
+    """One row per row_id with the minimum dist_arcsec (first-seen row_id order)."""
+    g = tbl.group_by("row_id", use_threads=False).aggregate([("dist_arcsec", "min")])
+    return pa.table({"row_id": g["row_id"], "dist_arcsec": g["dist_arcsec_min"]})
+
+def load_seed_row_ids(seed_dir: Path) -> pa.Table:
     """
     Load all row_id values from seed positions chunks. Expect columns: row_id,ra,dec.
-    Returns a DataFrame with unique row_id.
+    Returns a one-column Arrow table of unique row_id (first-seen order).
     """
     files = sorted((seed_dir).rglob("positions_chunk_*.csv"))
     if not files:
         raise RuntimeError(f"No positions_chunk_*.csv under {seed_dir}")
-    frames = []
-    for f in files:
-        df = pd.read_csv(f, usecols=["row_id"], dtype={"row_id": "string"})
-        frames.append(df)
-    all_ids = pd.concat(frames, ignore_index=True).drop_duplicates(subset=["row_id"])
-    all_ids["row_id"] = all_ids["row_id"].astype("string")
-    return all_ids
+    chunks = [
+        pacsv.read_csv(f, convert_options=pacsv.ConvertOptions(
+            include_columns=["row_id"], column_types={"row_id": pa.string()}, strings_can_be_null=True,
+        ))["row_id"]
+        for f in files
+    ]
+    return pa.table({"row_id": pc.unique(pa.chunked_array(chunks, pa.string()))})
+
+def attach_matches(seed: pa.Table, matches: pa.Table) -> pa.Table:
+    """Left-join matches onto the seed row_ids (Arrow hash join), keeping seed order."""
+    seed = seed.append_column("__row", pa.array(range(seed.num_rows), pa.int64()))
+    out = seed.join(matches, keys="row_id", join_type="left outer", use_threads=True)
+    # the hash join does not preserve input order (pandas merge how='left' did)
+    out = out.sort_by("__row").drop_columns(["__row"])
+    return out.set_column(out.schema.get_field_index("has_ir_match"), "has_ir_match",
+                          pc.fill_null(out["has_ir_match"], False))
 
 def main():
     ap = argparse.ArgumentParser()
@@ -78,63 +128,67 @@ def main():
     out_parquet = Path(args.out_parquet)
     out_parquet.parent.mkdir(parents=True, exist_ok=True)
 
-    # Aggregate matches
-    agg = {}  # row_id -> min_sep
+    # Aggregate matches: per batch, keep rows within radius, canonicalize their
+    # row_id and reduce to min sep; partial results are re-reduced as they grow.
+    partials = []
+    partial_rows = 0
+    compacted_rows = 0  # unique row_ids after the last compaction
     n_files = 0
     n_rows = 0
     for f in iter_closest_files(closest_dir):
         n_files += 1
-        df = pd.read_csv(f, dtype={"row_id": "string"}, low_memory=False)
-        if "row_id" not in df.columns:
+        reader = open_closest_csv(f)
+        names = reader.schema.names
+        if "row_id" not in names:
             continue
-        sep_col = "sep_arcsec" if "sep_arcsec" in df.columns else ("dist_arcsec" if "dist_arcsec" in df.columns else None)
+        sep_col = "sep_arcsec" if "sep_arcsec" in names else ("dist_arcsec" if "dist_arcsec" in names else None)
         if sep_col is None:
             continue
-        # canonicalize row_id safely
-        ids = df["row_id"].astype("string").map(canonical_row_id)
-        seps = pd.to_numeric(df[sep_col], errors="coerce")
 
-        for rid, sep in zip(ids, seps):
-            n_rows += 1
-            if rid is None or pd.isna(sep):
+        for batch in reader:
+            n_rows += batch.num_rows
+            seps = batch.column(sep_col)
+            keep = pc.and_(pc.is_valid(batch.column("row_id")), pc.less_equal(seps, args.radius_arcsec))
+            ids = canonical_row_ids(pc.filter(batch.column("row_id"), keep))
+            part = pa.table({"row_id": ids, "dist_arcsec": pc.filter(seps, keep)})
+            part = part.filter(pc.is_valid(part["row_id"]))
+            if part.num_rows == 0:
                 continue
-            if sep > args.radius_arcsec:
-                continue
-            prev = agg.get(rid)
-            if prev is None or sep < prev:
-                agg[rid] = float(sep)
+            partials.append(min_sep_per_row_id(part))
+            partial_rows += partials[-1].num_rows
+            # the threshold grows with the compacted set, so once there are more than
+            # COMPACT_ROWS unique ids a compaction still needs that many new rows (amortized)
+            if partial_rows > max(COMPACT_ROWS, 2 * compacted_rows):
+                partials = [min_sep_per_row_id(pa.concat_tables(partials))]
+                partial_rows = compacted_rows = partials[0].num_rows
 
         if n_files % 500 == 0:
-            print(f"[INFO] processed {n_files} closest files; current unique matches={len(agg)}")
+            print(f"[INFO] processed {n_files} closest files; partial matches={partial_rows}")
 
-    print(f"[INFO] scanned closest files={n_files}; rows_seen~={n_rows}; unique_matched_row_id={len(agg)}")
+    if partials:
+        matches = min_sep_per_row_id(pa.concat_tables(partials))
+    else:
+        matches = pa.table({"row_id": pa.array([], pa.string()), "dist_arcsec": pa.array([], pa.float64())})
+    del partials
 
-    match_df = pd.DataFrame({"row_id": list(agg.keys()), "dist_arcsec": list(agg.values())})
-    match_df["row_id"] = match_df["row_id"].astype("string")
-    match_df["has_ir_match"] = True
+    print(f"[INFO] scanned closest files={n_files}; rows_seen~={n_rows}; unique_matched_row_id={matches.num_rows}")
 
-    # If we have seed dir, left join to make full sidecar (row_id list from master)
-    if args.seed_dir:
-        seed_df = load_seed_row_ids(Path(args.seed_dir))
-        out_df = seed_df.merge(match_df, on="row_id", how="left")
-        out_df["has_ir_match"] = out_df["has_ir_match"].fillna(False).astype(bool)
-    else:
-        # matches-only sidecar; downstream must treat missing row_id as False
-        out_df = match_df[["row_id", "has_ir_match", "dist_arcsec"]]
+    matches = matches.append_column("has_ir_match", pa.nulls(matches.num_rows, pa.bool_()).fill_null(True))
 
-    # Ensure columns exist
-    if "dist_arcsec" not in out_df.columns:
-        out_df["dist_arcsec"] = pd.NA
+    # If we have seed dir, left join to make full sidecar (row_id list from master);
+    # otherwise a matches-only sidecar (downstream must treat missing row_id as False)
+    if args.seed_dir:
+        matches = attach_matches(load_seed_row_ids(Path(args.seed_dir)), matches)
 
-    out_df = out_df[["row_id", "has_ir_match", "dist_arcsec"]]
     schema = pa.schema([
         pa.field("row_id", pa.string()),
         pa.field("has_ir_match", pa.bool_()),
         pa.field("dist_arcsec", pa.float64()),
     ])
-    table = pa.Table.from_pandas(out_df, schema=schema, preserve_index=False)
-    pq.write_table(table, out_parquet)
-    print(f"[OK] wrote sidecar: {out_parquet} rows={len(out_df)}")
+    table = matches.select(schema.names).cast(schema)
+    pq.write_table(table, out_parquet, compression="zstd", compression_level=3,
+                   use_dictionary=False, row_group_size=256_000, data_page_size=1 << 20)
+    print(f"[OK] wrote sidecar: {out_parquet} rows={table.num_rows}")
 
 if __name__ == "__main__":
     main()
@@ -21,9 +21,34 @@ Usage:
 
 import argparse, os, re, sys
 import pandas as pd
+import pyarrow as pa
 import pyarrow.dataset as pds
 from pyarrow import fs as pafs
 
+# Sidecar columns this formatter reads; everything else is never decoded.
+SIDECAR_COLS = [
+    "opt_source_id", "row_id", "opt_ra_deg", "opt_dec_deg", "cntr", "ra", "dec", "mjd",
+    "w1snr", "w2snr", "qual_frame", "qi_fact", "saa_sep", "moon_masked", "sep_arcsec",
+]
+
+# closest CSV column <- sidecar column, with the dtype used for an all-null
+# column when the sidecar does not carry it.
+CLOSEST_FROM_SIDECAR = [
+    ("in_ra",       "opt_ra_deg",  "float64"),
+    ("in_dec",      "opt_dec_deg", "float64"),
+    ("cntr",        "cntr",        "Int64"),
+    ("ra",          "ra",          "float64"),
+    ("dec",         "dec",         "float64"),
+    ("mjd",         "mjd",         "float64"),
+    ("w1snr",       "w1snr",       "float64"),
+    ("w2snr",       "w2snr",       "float64"),
+    ("qual_frame",  "qual_frame",  "Int64"),
+    ("qi_fact",     "qi_fact",     "float64"),
+    ("saa_sep",     "saa_sep",     "float64"),
+    ("moon_masked", "moon_masked", "string"),
+    ("sep_arcsec",  "sep_arcsec",  "float64"),
+]
+
 def _mk_s3fs():
     return pafs.S3FileSystem(anonymous=False, region="us-west-2")
 
@@ -72,14 +97,14 @@ def main():
 
     os.makedirs(a.out_dir, exist_ok=True)
 
-    # Load sidecar (ALL) – must contain 'opt_source_id' and NEOWISE columns
+    # Open sidecar (ALL) – must contain 'opt_source_id' and NEOWISE columns
     try:
-        neo = pd.read_parquet(a.sidecar_all)
+        neo_ds = pds.dataset(a.sidecar_all, format="parquet")
     except Exception as e:
         print(f"[ERROR] reading sidecar-all '{a.sidecar_all}': {e}", file=sys.stderr)
         sys.exit(2)
 
-    if "opt_source_id" not in neo.columns:
+    if "opt_source_id" not in neo_ds.schema.names:
         print("[ERROR] Sidecar file missing 'opt_source_id' column.", file=sys.stderr)
         sys.exit(2)
 
@@ -91,31 +116,37 @@ def main():
         join_cols.append("row_id")
     opt_small = opt[join_cols].copy()
 
-    # INNER JOIN: only seeds of THIS chunk survive
+    # Semi-join in the Arrow scan: only sidecar rows whose opt_source_id is one of
+    # this chunk's seeds are decoded and converted to pandas (row order kept).
+    try:
+        key_type = neo_ds.schema.field("opt_source_id").type
+        seeds = pa.array(opt_small["source_id"]).cast(key_type)
+        neo = neo_ds.to_table(
+            columns=[c for c in SIDECAR_COLS if c in neo_ds.schema.names],
+            filter=pds.field("opt_source_id").isin(seeds),
+        ).to_pandas()
+    except Exception as e:
+        print(f"[ERROR] reading sidecar-all '{a.sidecar_all}': {e}", file=sys.stderr)
+        sys.exit(2)
+
+    # INNER JOIN: only seeds of THIS chunk survive (now on the pre-filtered rows)
     neo = neo.merge(opt_small, left_on="opt_source_id", right_on="source_id",
                     how="inner", validate="m:1", suffixes=("", "__opt"))
 
-    # Build output frame; prefer provided row_id; fallback to opt_source_id
-    out = pd.DataFrame({
-        "row_id": [ _to_row_id(s, r, a.row_id_float)
-                    for s, r in zip(neo.get("opt_source_id"), neo.get("row_id")) ],
-        "in_ra":        neo.get("opt_ra_deg"),
-        "in_dec":       neo.get("opt_dec_deg"),
-        "cntr":         neo.get("cntr"),
-        "ra":           neo.get("ra"),
-        "dec":          neo.get("dec"),
-        "mjd":          neo.get("mjd"),
-        "w1snr":        neo.get("w1snr"),
-        "w2snr":        neo.get("w2snr"),
-        "qual_frame":   neo.get("qual_frame"),
-        "qi_fact":      neo.get("qi_fact"),
-        "saa_sep":      neo.get("saa_sep"),
-        "moon_masked":  neo.get("moon_masked"),
-        "sep_arcsec":   neo.get("sep_arcsec"),
-    })[[
-        "row_id","in_ra","in_dec","cntr","ra","dec","mjd","w1snr","w2snr",
-        "qual_frame","qi_fact","saa_sep","moon_masked","sep_arcsec"
-    ]]
+    # Build output frame; prefer provided row_id; fallback to opt_source_id.
+    # Missing sidecar columns become explicit typed null columns (no None broadcast).
+    def col_or_null(name: str, dtype: str) -> pd.Series:
+        if name in neo.columns:
+            return neo[name]
+        return pd.Series(pd.NA if dtype != "float64" else float("nan"), index=neo.index, dtype=dtype)
+
+    row_ids = col_or_null("row_id", "string")
+    out = pd.DataFrame(
+        {"row_id": [_to_row_id(s, r, a.row_id_float) for s, r in zip(neo["opt_source_id"], row_ids)]},
+        index=neo.index,
+    )
+    for dst, src, dtype in CLOSEST_FROM_SIDECAR:
+        out[dst] = col_or_null(src, dtype)
 
     cid = _infer_chunk_id_from_path(a.optical_root) or "unknown"
 
@@ -209,7 +209,9 @@ def load_skybot_flags_parts(parts_glob: str) -> pd.DataFrame:
     if missing:
         raise SystemExit(f"[ERROR] SkyBoT parts missing columns: {missing}")
     df["src_id"] = df["src_id"].astype(str)
-    df["skybot_flagged"] = df["has_skybot_match"].fillna(False).astype(bool) | df["wide_skybot_match"].fillna(False).astype(bool)
+    # nullable parquet booleans arrive as object columns; go straight to numpy bool (null -> False)
+    df["skybot_flagged"] = (df["has_skybot_match"].to_numpy(dtype=bool, na_value=False)
+                            | df["wide_skybot_match"].to_numpy(dtype=bool, na_value=False))
     return df[["src_id", "skybot_flagged"]]
 
 
@@ -297,13 +299,13 @@ def main():
     rep_flags = sb.groupby("rep_src_id", as_index=False)["skybot_flagged"].any()
     rep_flags = rep_flags.rename(columns={"rep_src_id": "src_id"})
 
-    # Join onto dedup survivors and shrink
-    merged = d.merge(rep_flags, on="src_id", how="left")
-    merged["skybot_flagged"] = merged["skybot_flagged"].fillna(False).astype(bool)
+    # Flag dedup survivors by membership in the flagged reps (a left merge would copy every
+    # column and leave an object-dtype NaN/bool column behind) and shrink
+    flagged = d["src_id"].isin(rep_flags.loc[rep_flags["skybot_flagged"], "src_id"]).to_numpy()
 
-    rows_in = len(merged)
-    rows_flagged = int(merged["skybot_flagged"].sum())
-    survivors = merged.loc[~merged["skybot_flagged"]].copy()
+    rows_in = len(d)
+    rows_flagged = int(flagged.sum())
+    survivors = d.loc[~flagged]
     rows_out = len(survivors)
 
     print(f"[RESULT] rows_in(dedup_edge_core)={rows_in}  skybot_flagged={rows_flagged}  rows_out={rows_out}")
@@ -31,6 +31,8 @@ import sys
 from pathlib import Path
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
 
 
 def safe_num(df: pd.DataFrame, name: str, default: float = 0.0) -> pd.Series:
@@ -39,6 +41,27 @@ def safe_num(df: pd.DataFrame, name: str, default: float = 0.0) -> pd.Series:
     return pd.Series(np.full(len(df), default), index=df.index, dtype="float64")
 
 
+def flag_mask(s: pd.Series) -> np.ndarray:
+    """
+    Boolean flag column -> plain numpy mask; null/unknown -> False.
+    Evaluated with pyarrow.compute (no nullable "boolean" extension array).
+    """
+    if s.dtype == bool:
+        return s.to_numpy()
+    arr = pa.array(s, from_pandas=True)
+    if pa.types.is_string(arr.type) or pa.types.is_large_string(arr.type):
+        arr = pc.equal(pc.utf8_trim_whitespace(arr), "True")
+    elif not pa.types.is_boolean(arr.type):
+        arr = pc.cast(arr, pa.bool_())
+    return pc.fill_null(arr, False).to_numpy(zero_copy_only=False)
+
+
+def within_radius(s: pd.Series, radius_arcsec: float) -> np.ndarray:
+    """sep <= radius as a numpy mask; non-numeric/NaN -> False."""
+    arr = pa.array(pd.to_numeric(s, errors="coerce"), from_pandas=True)
+    return pc.fill_null(pc.less_equal(arr, radius_arcsec), False).to_numpy(zero_copy_only=False)
+
+
 def compute_matches(df: pd.DataFrame, radius_arcsec: float) -> pd.DataFrame:
     """
     Preference order for strict matches:
@@ -48,28 +71,16 @@ def compute_matches(df: pd.DataFrame, radius_arcsec: float) -> pd.DataFrame:
       4) dist_arcsec <= radius (minimal sidecar separation)
     """
     if "has_ir_match" in df.columns:
-        strict = (
-            df["has_ir_match"]
-            .replace({"True": True, "False": False})
-            .astype("boolean")
-            .fillna(False)
-        )
-        return df[strict]
+        return df[flag_mask(df["has_ir_match"])]
 
     if "ir_match_strict" in df.columns:
-        strict = (
-            df["ir_match_strict"]
-            .replace({"True": True, "False": False})
-            .astype("boolean")
-            .fillna(False)
-        )
-        return df[strict]
+        return df[flag_mask(df["ir_match_strict"])]
 
     if "sep_arcsec" in df.columns:
-        return df[pd.to_numeric(df["sep_arcsec"], errors="coerce").le(radius_arcsec)]
+        return df[within_radius(df["sep_arcsec"], radius_arcsec)]
 
     if "dist_arcsec" in df.columns:
-        return df[pd.to_numeric(df["dist_arcsec"], errors="coerce").le(radius_arcsec)]
+        return df[within_radius(df["dist_arcsec"], radius_arcsec)]
 
     raise SystemExit(
         "Missing a usable strict-match signal: expected one of "
@@ -166,8 +177,10 @@ def main():
     # Partition awareness — optional
     if ("ra_bin" in df.columns) and ("dec_bin" in df.columns):
         rb = df["ra_bin"]; db = df["dec_bin"]
-        rows_with_bins = int((rb.notna() & db.notna()).sum())
-        pair_count = int(len(pd.DataFrame({"rb": rb, "db": db}).dropna().drop_duplicates()))
+        both = (rb.notna() & db.notna()).to_numpy()
+        rows_with_bins = int(both.sum())
+        # distinct (ra_bin, dec_bin) pairs: hash the two columns directly, no temp frame
+        pair_count = int((~pd.MultiIndex.from_arrays([rb[both], db[both]]).duplicated()).sum())
     else:
         rows_with_bins = 0
         pair_count = 0
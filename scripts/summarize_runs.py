@@ -285,8 +285,9 @@ def summarize_ir_flags(flags_parquet: Path, radius_arcsec: float) -> Dict:
     if ("ra_bin" in df.columns) and ("dec_bin" in df.columns):
         rb = df["ra_bin"]
         db = df["dec_bin"]
-        out["ir_rows_with_bins"] = int((rb.notna() & db.notna()).sum())
-        out["ir_partitions_with_bins"] = int(len(pd.DataFrame({"rb": rb, "db": db}).dropna().drop_duplicates()))
+        both = (rb.notna() & db.notna()).to_numpy()
+        out["ir_rows_with_bins"] = int(both.sum())
+        out["ir_partitions_with_bins"] = int((~pd.MultiIndex.from_arrays([rb[both], db[both]]).duplicated()).sum())
     return out
 
 # ------------------------------ writers ------------------------------
@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+"""
+SQL text helpers shared by the Post 1.6 DuckDB scripts (export_masked_view.py,
+final_candidates_post16.py). Plain module under scripts/, like utils_epoch.py.
+"""
+from __future__ import annotations
+
+
+def sql_quote(s: str) -> str:
+    return "'" + str(s).replace("'", "''") + "'"
+
+
+def typed(col: str, types: dict, want: str) -> str:
+    """col as-is when DESCRIBE already reports the wanted type (no per-row cast), else col::want."""
+    return col if types.get(col) == want else f"{col}::{want}"
+
+
+def packed_grid_key(ra: str, dec: str, grid: float) -> str:
+    """
+    SQL for one BIGINT dedupe cell key: round(ra/grid) in the high 32 bits, round(dec/grid)
+    (two's complement) in the low 32. Exact (no hash collisions) for any grid >= ~0.0003".
+    Arithmetic instead of << because DuckDB refuses to shift negative values.
+    """
+    return (f"(CAST(round({ra}/{grid}) AS BIGINT) * 4294967296"
+            f" + (CAST(round({dec}/{grid}) AS BIGINT) & 4294967295))")
+
+
+def parquet_copy_options(compression: str, row_group_size: int,
+                         compression_level: int | None = None) -> str:
+    """
+    COPY ... TO options for the Parquet outputs. Large row groups amortize footer metadata;
+    zstd matches snappy's write speed at a smaller size. The level applies to zstd only.
+    """
+    opts = f"FORMAT PARQUET, COMPRESSION {sql_quote(compression)}, ROW_GROUP_SIZE {int(row_group_size)}"
+    if compression_level is not None and compression == "zstd":
+        opts += f", COMPRESSION_LEVEL {int(compression_level)}"
+    return opts
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+"""
+Filesystem helpers shared by the NEOWISE positions/sidecar scripts under scripts/legacy/
+(concat_flags_and_write_sidecar.py, rebuild_neowise_sidecar_from_existing_closest.py,
+extract_positions_for_neowise_se.py).
+Plain module under scripts/, like utils_epoch.py.
+"""
+from __future__ import annotations
+
+import os
+from pathlib import Path
+from typing import List
+
+
+def scan_closest(base: str, out: List[str]) -> None:
+    """Recursive os.scandir collecting *_closest.csv as str paths (no per-entry Path objects)."""
+    try:
+        it = os.scandir(base)
+    except (FileNotFoundError, NotADirectoryError):
+        return
+    with it:
+        for e in it:
+            if e.is_dir(follow_symlinks=False):
+                scan_closest(e.path, out)
+            elif e.name.endswith("_closest.csv"):
+                out.append(e.path)
+
+
+def fsync_path(path: Path) -> None:
+    """fsync a file, or a directory entry table (POSIX; no-op where dirs cannot be opened)."""
+    flags = os.O_RDONLY | (getattr(os, "O_DIRECTORY", 0) if path.is_dir() else 0)
+    try:
+        fd = os.open(path, flags)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def atomic_write_text(path: Path, text: str) -> None:
+    """Durably replace path with text: write <name>.tmp, fsync, rename, fsync the parent dir."""
+    tmp = path.with_name(path.name + ".tmp")
+    with tmp.open("w", encoding="utf-8") as f:
+        f.write(text)
+        f.flush(); os.fsync(f.fileno())
+    tmp.replace(path)
+    fsync_path(path.parent)